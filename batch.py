@@ -0,0 +1,307 @@
+"""
+Headless batch processing of many videos.
+
+Usage example:
+
+    > python batch.py config.npz "videos/*.avi" -o results -j 4
+
+The config file is created with "Save ROI config" in the GUI. Kivy is never
+imported, so worker processes start quickly.
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+from frame_cache import DEFAULT_CACHE_SIZE
+from frame_differences import calculate_frame_diffs_wcall
+from kernels import BACKENDS
+from results import SINKS, DEFAULT_HISTOGRAM_BINS
+from roi_config import load_config
+from stats import DEFAULT_PROGRESS_INTERVAL, PipelineStats, format_progress
+
+SUMMARY_COLUMNS = ["Video", "Output", "Status", "Error", "Seconds", "Rows"]
+
+
+def expand_videos(patterns):
+    """
+    Expands glob patterns into a sorted list of unique video files.
+    """
+    videos = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) \
+            else [pattern]
+        for m in matches:
+            if m not in videos:
+                videos.append(m)
+    return videos
+
+
+def output_paths(videos, output_dir, extension=".csv"):
+    """
+    Returns result file paths of video files, named after the videos.
+    Videos whose names would collide (e.g. a/cam.avi and b/cam.avi) keep
+    their directory relative to the common directory of all videos, and
+    also their extension if names still collide (cam.avi and cam.mp4).
+    """
+    paths = [os.path.abspath(v) for v in videos]
+    if not paths:
+        return []
+    root = os.path.commonpath([os.path.dirname(p) for p in paths])
+    names = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    for rename in (lambda p: os.path.splitext(os.path.relpath(p, root))[0],
+                   lambda p: os.path.relpath(p, root)):
+        counts = collections.Counter(names)
+        names = [rename(p) if counts[name] > 1 else name
+                 for p, name in zip(paths, names)]
+    return [os.path.join(output_dir, name + extension) for name in names]
+
+
+def partial_path(output_file):
+    """
+    Returns the path to which a result file is written until its video is
+    processed (<name>.partial<extension>).
+    """
+    root, extension = os.path.splitext(output_file)
+    return root + ".partial" + extension
+
+
+def result_files(output_file, histograms=False):
+    """
+    Returns the files making up the result of a video: the result file,
+    CSV metadata and with histograms, the histogram file.
+    """
+    files = [output_file, output_file + ".json"]
+    if histograms:
+        files.append(os.path.splitext(output_file)[0] + ".hist.npz")
+    return files
+
+
+def threshold_value(text):
+    """
+    Converts a threshold argument to int, or to float if it has decimals.
+    """
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+
+def process_video(video_file, config_file, output_file,
+                  pixel_diff_threshold=10, chunk_workers=1,
+                  chunk_duration=None, checkpoint_interval=None,
+                  resume=False, downsample=1, downsample_mode="block",
+                  sample_rate=None, skip_frames=None, cache_dir=None,
+                  cache_size=DEFAULT_CACHE_SIZE, diff_cache_dir=None,
+                  histogram_bins=None, block_frames=None,
+                  backend="auto", write_stats=False,
+                  progress_interval=None):
+    """
+    Processes a single video and writes its result file. With
+    histogram_bins, per-ROI histograms are written to <result>.hist.npz.
+    Results are written to partial files (see partial_path), renamed when
+    the video is done, so result files are never left incomplete; partial
+    files of a failed video are removed unless they are kept for resuming
+    from a checkpoint. With write_stats, stage times and frame counters
+    (see PipelineStats) are written to <result>.stats.json. With
+    progress_interval, a progress line (see stats.ProgressMeter) is
+    printed to stderr every progress_interval seconds.
+
+    Returns a summary row (dict) for the video; exceptions are reported in
+    the row instead of being raised.
+    """
+    start = time.time()
+    row = {"Video": video_file, "Output": output_file, "Status": "ok",
+           "Error": "", "Rows": 0}
+    final_files = result_files(output_file, bool(histogram_bins))
+    partial_files = result_files(partial_path(output_file),
+                                 bool(histogram_bins))
+    try:
+        masks, cut_ranges = load_config(config_file, geometry=True)
+        stats = PipelineStats() if write_stats else None
+        progress_callback = None
+        if progress_interval is not None:
+            def progress_callback(record):
+                print("{0}: {1}".format(video_file, format_progress(record)),
+                      file=sys.stderr, flush=True)
+        histogram_output = partial_files[2] if histogram_bins else None
+        row["Rows"] = calculate_frame_diffs_wcall(
+            video_file, masks, cut_ranges,
+            pixel_diff_threshold=pixel_diff_threshold,
+            workers=chunk_workers, chunk_duration=chunk_duration,
+            output=partial_files[0], checkpoint_interval=checkpoint_interval,
+            resume=resume, downsample=downsample,
+            downsample_mode=downsample_mode, sample_rate=sample_rate,
+            skip_frames=skip_frames, cache_dir=cache_dir,
+            cache_size=cache_size, diff_cache_dir=diff_cache_dir,
+            histogram_output=histogram_output,
+            histogram_bins=histogram_bins or DEFAULT_HISTOGRAM_BINS,
+            block_frames=block_frames, backend=backend, stats=stats,
+            progress_callback=progress_callback,
+            progress_interval=progress_interval or DEFAULT_PROGRESS_INTERVAL)
+        for partial, final in zip(partial_files, final_files):
+            if os.path.isfile(partial):
+                os.replace(partial, final)
+        if stats is not None:
+            with open(os.path.splitext(output_file)[0] + ".stats.json",
+                      "w") as f:
+                json.dump(stats.summary(), f, indent=2)
+    except Exception as e:
+        row["Status"] = "failed"
+        row["Error"] = "{0}: {1}".format(type(e).__name__, e)
+        if checkpoint_interval is None:
+            for partial in partial_files:
+                if os.path.isfile(partial):
+                    os.remove(partial)
+    row["Seconds"] = round(time.time() - start, 3)
+    return row
+
+
+def run_batch(videos, config_file, output_dir, workers=None,
+              pixel_diff_threshold=10, summary_file=None, chunk_workers=1,
+              chunk_duration=None, extension=".csv",
+              checkpoint_interval=None, resume=False, downsample=1,
+              downsample_mode="block", sample_rate=None, skip_frames=None,
+              cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+              diff_cache_dir=None, histogram_bins=None, block_frames=None,
+              backend="auto", write_stats=False, progress_interval=None):
+    """
+    Processes videos in a pool of worker processes.
+
+    Returns list of summary rows, in the order of videos.
+    """
+    outputs = output_paths(videos, output_dir, extension)
+    for directory in set(os.path.dirname(o) for o in outputs) | {output_dir}:
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_video, v, config_file, o,
+                               pixel_diff_threshold, chunk_workers,
+                               chunk_duration, checkpoint_interval, resume,
+                               downsample, downsample_mode, sample_rate,
+                               skip_frames, cache_dir, cache_size,
+                               diff_cache_dir, histogram_bins, block_frames,
+                               backend, write_stats, progress_interval)
+                   for v, o in zip(videos, outputs)]
+        for f in concurrent.futures.as_completed(futures):
+            row = f.result()
+            print("{0}: {1} ({2:.1f} s) {3}".format(
+                row["Status"], row["Video"], row["Seconds"], row["Error"]))
+        summary = [f.result() for f in futures]
+
+    if summary_file is not None:
+        with open(summary_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+            writer.writerows(summary)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Calculates frame differences for many videos.")
+    parser.add_argument("config", help="ROI/cutpoint config (.npz) saved "
+                        "from the GUI")
+    parser.add_argument("videos", nargs="+", help="video files or glob "
+                        "patterns")
+    parser.add_argument("-o", "--output-dir", default=".",
+                        help="directory for result files")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number "
+                        "of CPUs)")
+    parser.add_argument("-c", "--chunk-workers", type=int, default=1,
+                        help="number of processes splitting each video "
+                        "(useful for a few long videos)")
+    parser.add_argument("--chunk-duration", type=float, default=None,
+                        help="maximal length in seconds of a video part "
+                        "analysed by one chunk worker")
+    parser.add_argument("-f", "--format", default="csv",
+                        choices=sorted(ext[1:] for ext in SINKS),
+                        help="result file format")
+    parser.add_argument("-t", "--threshold", type=threshold_value,
+                        nargs="+", default=[10],
+                        help="pixel difference threshold; with several "
+                        "thresholds, results for all of them are computed "
+                        "in one pass")
+    parser.add_argument("-d", "--downsample", type=int, default=1,
+                        help="reduce frames by this factor before "
+                        "differencing")
+    parser.add_argument("--downsample-mode", default="block",
+                        choices=["block", "decoder"],
+                        help="block averaging or decoder scaling")
+    parser.add_argument("-r", "--sample-rate", type=float, default=None,
+                        metavar="HZ",
+                        help="compare frames sampled at about HZ per second "
+                        "instead of consecutive frames")
+    parser.add_argument("--skip-frames", default=None,
+                        choices=["noref", "nokey"],
+                        help="let the decoder skip non-reference frames or "
+                        "all frames but keyframes")
+    parser.add_argument("--histograms", type=int, nargs="?", default=None,
+                        const=DEFAULT_HISTOGRAM_BINS, metavar="BINS",
+                        help="also write per-ROI histograms of absolute "
+                        "pixel differences with BINS bins (default: "
+                        "%(const)d) to <video>.hist.npz")
+    parser.add_argument("--block-frames", type=int, default=None,
+                        metavar="N",
+                        help="difference N frames at a time (default: "
+                        "chosen from the frame size; 1 disables blocks)")
+    parser.add_argument("--backend", default="auto", choices=BACKENDS,
+                        help="difference kernel: numba compiles a fused "
+                        "kernel (requires Numba), auto uses it when Numba "
+                        "is installed")
+    parser.add_argument("--cache-dir", default=None,
+                        help="keep decoded frames in this directory, so "
+                        "that repeated runs do not decode videos again")
+    parser.add_argument("--cache-size", type=float,
+                        default=DEFAULT_CACHE_SIZE / 2**30, metavar="GB",
+                        help="size limit of each cache (default: "
+                        "%(default)g GB)")
+    parser.add_argument("--diff-cache", default=None, metavar="DIR",
+                        help="keep frame differences in this directory, so "
+                        "that runs with other ROIs only recompute ROI "
+                        "results")
+    parser.add_argument("--stats", action="store_true",
+                        help="write stage times and frame counters of each "
+                        "video to <video>.stats.json")
+    parser.add_argument("--progress", type=float, default=None,
+                        metavar="SECONDS",
+                        help="print frames, frames/s, realtime factor and "
+                        "ETA of each video every SECONDS seconds")
+    parser.add_argument("--checkpoint", type=float, default=None,
+                        metavar="SECONDS",
+                        help="save progress every SECONDS seconds")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue interrupted videos from their "
+                        "checkpoints")
+    parser.add_argument("-s", "--summary", default=None,
+                        help="summary report file (default: "
+                        "<output-dir>/summary.csv)")
+    args = parser.parse_args(argv)
+
+    videos = expand_videos(args.videos)
+    if not videos:
+        parser.error("no videos found")
+    summary_file = args.summary or os.path.join(args.output_dir,
+                                                "summary.csv")
+    threshold = args.threshold[0] if len(args.threshold) == 1 \
+        else args.threshold
+    summary = run_batch(videos, args.config, args.output_dir, args.workers,
+                        threshold, summary_file, args.chunk_workers,
+                        args.chunk_duration, "." + args.format,
+                        args.checkpoint, args.resume, args.downsample,
+                        args.downsample_mode, args.sample_rate,
+                        args.skip_frames, args.cache_dir,
+                        int(args.cache_size * 2**30), args.diff_cache,
+                        args.histograms, args.block_frames, args.backend,
+                        args.stats, args.progress)
+    failed = sum(row["Status"] != "ok" for row in summary)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
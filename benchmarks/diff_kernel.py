@@ -0,0 +1,249 @@
+"""
+Measures time and memory allocated per frame by the frame difference step.
+
+Usage:
+
+    > python benchmarks/diff_kernel.py [--size 1920 1080] [-n 200]
+          [--sweep 5 10 20 40] [--histograms 32] [--block 16]
+          [--backends]
+
+Random frames with a moving bright square are compared with the expression
+used before DiffKernel and with DiffKernel, both followed by ROI counting
+(four quadrant ROIs). The size of temporary arrays is traced with
+tracemalloc, which sees NumPy array buffers. Both variants are checked to
+give identical results; the script exits with status 1 when any check
+fails.
+With --sweep, the time of ThresholdSweep for the given thresholds is
+compared with separate runs for each threshold. With --histograms, the
+time of ROIEngine.histograms is compared with a loop over ROI masks. With
+--block, frames are differenced in blocks of the given number of frames
+(FrameBlock) and compared with frame by frame differencing; small frames
+(e.g. --size 320 240) gain the most. With --backends, the NumPy and the
+compiled (Numba) kernel backends are timed and checked to give identical
+results, differences and absolute differences, also for a threshold of 0,
+a fractional threshold and ROI layouts counted with bincount.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from downsample_accuracy import quadrant_masks  # noqa: E402
+from kernels import (DiffKernel, SingleThreshold, ThresholdSweep,  # noqa
+                     FrameBlock, resolve_backend, single_threshold)
+from roi_engine import ROIEngine  # noqa: E402
+
+
+def make_frames(shape, n, seed=0):
+    rng = np.random.RandomState(seed)
+    base = rng.randint(0, 256, size=shape).astype(np.uint8)
+    frames = []
+    for i in range(n):
+        f = base.copy()
+        noise = rng.randint(-12, 13, size=shape)
+        f = np.clip(f + noise, 0, 255).astype(np.uint8)
+        y = (i * 7) % (shape[0] // 2)
+        x = (i * 11) % (shape[1] // 2)
+        f[y:y + shape[0] // 4, x:x + shape[1] // 4] = 255
+        frames.append(f.ravel())
+    return frames
+
+
+def legacy_diff(th):
+    def diff(cframe, oframe):
+        return (cframe - oframe > th) & (oframe - cframe > th)
+    return diff
+
+
+def measure(diff, engine, frames):
+    """
+    Returns (seconds per frame, mean size in bytes of temporary arrays
+    alive during a frame, results). Timing is done without tracing.
+    """
+    start = time.perf_counter()
+    results = [engine.fractions(diff(cframe, oframe))
+               for oframe, cframe in zip(frames, frames[1:])]
+    elapsed = time.perf_counter() - start
+
+    temporary = 0
+    tracemalloc.start()
+    for oframe, cframe in zip(frames, frames[1:]):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        engine.fractions(diff(cframe, oframe))
+        temporary += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    n = len(frames) - 1
+    return elapsed / n, temporary / n, results
+
+
+def time_per_frame(measure, frames):
+    start = time.perf_counter()
+    for oframe, cframe in zip(frames, frames[1:]):
+        measure(cframe, oframe)
+    return (time.perf_counter() - start) / (len(frames) - 1)
+
+
+def time_blocks(block, frames):
+    """
+    Returns (seconds per frame, rows) of differencing frames in blocks.
+    """
+    start = time.perf_counter()
+    block.start(frames[0])
+    rows = []
+    for i, frame in enumerate(frames[1:]):
+        if block.add(frame, 0, i):
+            rows.append(block.flush()[0])
+    rows.append(block.flush()[0])
+    elapsed = time.perf_counter() - start
+    return elapsed / (len(frames) - 1), np.vstack(rows)
+
+
+def compare_backends(shape, threshold, masks, frames):
+    """
+    Returns (seconds per frame of each backend, whether all outputs are
+    identical).
+    """
+    engine = ROIEngine(masks)
+    outputs = []
+    times = []
+    for backend in ("numpy", "numba"):
+        measure = single_threshold(shape, threshold, engine, backend)
+        # The first call compiles the Numba kernel
+        measure(frames[1], frames[0])
+        output = []
+        start = time.perf_counter()
+        for oframe, cframe in zip(frames, frames[1:]):
+            output.append(measure(cframe, oframe))
+        times.append((time.perf_counter() - start) / (len(frames) - 1))
+        output.append(measure.frame_diff().copy())
+        output.append(measure.kernel.absdiff.copy())
+        outputs.append(output)
+    same = all(np.array_equal(a, b) for a, b in zip(*outputs))
+    return times, same
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", type=int, nargs=2, default=[1920, 1080],
+                        metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("-n", "--frames", type=int, default=200)
+    parser.add_argument("-t", "--threshold", type=int, default=10)
+    parser.add_argument("--sweep", type=int, nargs="+", default=None,
+                        metavar="THRESHOLD")
+    parser.add_argument("--histograms", type=int, default=None,
+                        metavar="BINS")
+    parser.add_argument("--block", type=int, default=None,
+                        metavar="FRAMES")
+    parser.add_argument("--backends", action="store_true")
+    args = parser.parse_args(argv)
+
+    shape = (args.size[1], args.size[0])
+    frames = make_frames(shape, args.frames)
+    engine = ROIEngine(quadrant_masks(shape))
+    # Warm up, so that one-time allocations are not counted
+    engine.fractions(np.zeros(shape[0]*shape[1], dtype=bool))
+
+    variants = [("expression", legacy_diff(args.threshold)),
+                ("DiffKernel", DiffKernel(shape[0]*shape[1],
+                                          args.threshold))]
+    reference = None
+    failed = False
+    for name, diff in variants:
+        per_frame, temporary, results = measure(diff, engine, frames)
+        print("{0:10s} {1:7.2f} ms/frame  {2:7.2f} MB of temporaries per "
+              "frame".format(name, per_frame*1e3, temporary/1e6))
+        if reference is None:
+            reference = results
+        elif results != reference:
+            print("  results differ from the expression!")
+            failed = True
+
+    if args.sweep:
+        frames = [f.reshape(shape) for f in frames]
+        sweep = time_per_frame(ThresholdSweep(shape, args.sweep, engine),
+                               frames)
+        single = sum(time_per_frame(SingleThreshold(shape, th, engine),
+                                    frames)
+                     for th in args.sweep)
+        print("sweep of {0} thresholds: {1:.2f} ms/frame, separately "
+              "{2:.2f} ms/frame".format(len(args.sweep), sweep*1e3,
+                                        single*1e3))
+
+    if args.block:
+        frames2d = [f.reshape(shape) for f in frames]
+        single = SingleThreshold(shape, args.threshold, engine)
+        start = time.perf_counter()
+        rows = [single(cframe, oframe)
+                for oframe, cframe in zip(frames2d, frames2d[1:])]
+        single_time = (time.perf_counter() - start) / (len(frames) - 1)
+        block = FrameBlock(shape, args.threshold, engine, args.block)
+        block_time, block_rows = time_blocks(block, frames2d)
+        same = np.array_equal(block_rows[:, 2:], rows)
+        failed |= not same
+        print("blocks of {0} frames: {1:.3f} ms/frame, frame by frame "
+              "{2:.3f} ms/frame{3}".format(
+                  args.block, block_time*1e3, single_time*1e3,
+                  "" if same else " (differ!)"))
+
+    if args.backends:
+        frames2d = [f.reshape(shape) for f in frames]
+        rng = np.random.RandomState(1)
+        layouts = [("quadrants", quadrant_masks(shape)),
+                   ("12 random ROIs", [rng.rand(*shape) < 0.2
+                                       for _ in range(12)]),
+                   ("no ROIs", [])]
+        try:
+            resolve_backend("numba")
+        except ImportError:
+            print("backends: Numba is not installed")
+            layouts = []
+        for name, masks in layouts:
+            for th in (args.threshold, 0, 7.5):
+                (numpy_time, numba_time), same = compare_backends(
+                    shape, th, masks, frames2d)
+                failed |= not same
+                print("{0}, threshold {1}: numba {2:.2f} ms/frame, numpy "
+                      "{3:.2f} ms/frame{4}".format(
+                          name, th, numba_time*1e3, numpy_time*1e3,
+                          "" if same else " (differ!)"))
+
+    if args.histograms:
+        bins = args.histograms
+        kernel = DiffKernel(shape, args.threshold)
+        masks = quadrant_masks(shape)
+        absdiff = kernel.abs_diff(frames[1].reshape(shape),
+                                  frames[0].reshape(shape))
+
+        def roi_loop():
+            shift = 8 - bins.bit_length() + 1
+            return np.array([np.bincount(absdiff[m] >> shift,
+                                         minlength=bins) for m in masks])
+
+        n = 10
+        start = time.perf_counter()
+        for _ in range(n):
+            batched = engine.histograms(absdiff, bins)
+        batched_time = (time.perf_counter() - start) / n
+        start = time.perf_counter()
+        for _ in range(n):
+            looped = roi_loop()
+        loop_time = (time.perf_counter() - start) / n
+        same = np.array_equal(batched, looped)
+        failed |= not same
+        print("histograms with {0} bins: {1:.2f} ms/frame, loop over ROIs "
+              "{2:.2f} ms/frame{3}".format(
+                  bins, batched_time*1e3, loop_time*1e3,
+                  "" if same else " (differ!)"))
+
+    # Mismatches fail the run, so that scripts notice them
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
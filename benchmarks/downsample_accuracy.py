@@ -0,0 +1,94 @@
+"""
+Compares speed and accuracy of downsampled analysis against full resolution.
+
+Usage:
+
+    > python benchmarks/downsample_accuracy.py video.avi [-f 2 4 8]
+
+Four rectangular ROIs (frame quadrants shrunk by 10%) are analysed. For every
+factor and mode the script prints running time, speedup, and for each column
+the mean absolute error and Pearson correlation with the full resolution
+result, over rows matched by range and time. The exit status is 1 when a
+run gives no rows.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from frame_differences import calculate_frame_diffs_wcall  # noqa: E402
+from frame_source import FrameSource  # noqa: E402
+
+
+def quadrant_masks(shape):
+    h, w = shape
+    masks = []
+    for y in (0, h // 2):
+        for x in (0, w // 2):
+            m = np.zeros(shape, dtype=bool)
+            m[y + h // 20:y + h // 2 - h // 20,
+              x + w // 20:x + w // 2 - w // 20] = True
+            masks.append(m)
+    return masks
+
+
+def frame_shape(video_file):
+    source = FrameSource(video_file, prefetch=1)
+    try:
+        next(source)
+        return source.frame_shape
+    finally:
+        source.close()
+
+
+def run(video_file, masks, **kwargs):
+    start = time.time()
+    res = calculate_frame_diffs_wcall(video_file, masks, ([0, 1], [True]),
+                                      **kwargs)
+    return time.time() - start, res.iloc[1:].reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("video")
+    parser.add_argument("-f", "--factors", type=int, nargs="+",
+                        default=[2, 4, 8])
+    args = parser.parse_args(argv)
+
+    masks = quadrant_masks(frame_shape(args.video))
+    full_time, full = run(args.video, masks)
+    columns = [c for c in full.columns if c not in ("Range", "Time")]
+    print("full resolution: {0:.2f} s, {1} frames".format(full_time,
+                                                        len(full)))
+
+    failed = False
+    for mode in ("block", "decoder"):
+        for factor in args.factors:
+            t, res = run(args.video, masks, downsample=factor,
+                         downsample_mode=mode)
+            print("{0} x{1}: {2:.2f} s (speedup {3:.1f})".format(
+                mode, factor, t, full_time / t))
+            if not len(res):
+                print("  error: no rows")
+                failed = True
+                continue
+            # Rows are matched by time, as runs may start with different
+            # frames (decoder scaling drops the duplicated first frame)
+            both = full.merge(res, on=["Range", "Time"],
+                              suffixes=("_full", ""))
+            print("  {0} of {1} rows matched".format(len(both), len(res)))
+            for c in columns:
+                a, b = both[c + "_full"].values, both[c].values
+                corr = np.corrcoef(a, b)[0, 1] if a.std() and b.std() \
+                    else float("nan")
+                print("  {0:8s} MAE {1:.5f}  r {2:.4f}".format(
+                    c, np.mean(np.abs(a - b)), corr))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
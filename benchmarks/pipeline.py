@@ -0,0 +1,220 @@
+"""
+Measures throughput of calculate_frame_diffs_wcall on synthetic videos.
+
+Usage:
+
+    > python benchmarks/pipeline.py [-o report.json] [--quick]
+          [--sizes 320x240 1280x720] [--fps 25 60] [--motion low high]
+          [--rois 1 4 16] [--layouts full split] [--seconds 10]
+
+Videos of rectangles moving over a noisy background are generated with
+ffpyplayer (MPEG-4) for every size, frame rate and motion level and kept
+in --video-dir, so later runs measure the same videos. Every video is then
+analysed for every ROI count and cut-range layout in a fresh process. For
+each case the report gives frames per second of the whole run, peak
+resident memory of the process, the time per frame of the stages (decode,
+diff, aggregate, callback, output) and the frame source counters collected
+by PipelineStats.
+
+The report is JSON (printed, or written to -o) with the versions of Python
+and NumPy, so reports of different revisions and machines can be compared.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from frame_differences import calculate_frame_diffs_wcall  # noqa: E402
+from frame_source import COUNTERS, FrameSource  # noqa: E402
+from kernels import BACKENDS, resolve_backend  # noqa: E402
+from stats import PipelineStats  # noqa: E402
+
+# Number of moving rectangles of a motion level
+MOTION = {"static": 0, "low": 1, "high": 8}
+# Cutpoints and selected ranges of a layout
+LAYOUTS = {"full": ([0, 1], [True]),
+           "split": ([0, 0.25, 0.5, 0.75, 1], [True, False, True, False]),
+           "many": (list(np.linspace(0, 1, 21)), [True, False] * 10)}
+QUICK = dict(sizes=["320x240"], fps=[25], motion=["low"], rois=[4],
+             layouts=["full"], seconds=3)
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def synthetic_video(directory, size, fps, motion, seconds, seed=0):
+    """
+    Returns the path of a synthetic video, writing it if it does not exist.
+    The content depends only on the arguments.
+    """
+    from ffpyplayer.pic import Image
+    from ffpyplayer.writer import MediaWriter
+
+    width, height = size
+    filename = os.path.join(directory, "synthetic_{0}x{1}_{2}fps_{3}_{4:g}s"
+                            ".avi".format(width, height, fps, motion,
+                                          seconds))
+    if os.path.isfile(filename):
+        return filename
+    tmp = filename + ".tmp.avi"
+    rng = np.random.RandomState(seed)
+    background = rng.randint(0, 200, size=(height, width)).astype(np.uint8)
+    n_objects = MOTION[motion]
+    positions = rng.rand(n_objects, 2) * [height, width]
+    velocities = (rng.rand(n_objects, 2) - 0.5) * [height, width] / 20
+    side = max(4, min(width, height) // 8)
+
+    writer = MediaWriter(tmp, [dict(pix_fmt_in="gray", width_in=width,
+                                    height_in=height, codec="mpeg4",
+                                    pix_fmt_out="yuv420p",
+                                    frame_rate=(fps, 1))])
+    try:
+        for i in range(int(seconds * fps)):
+            frame = background.astype(np.int16)
+            frame += rng.randint(-3, 4, size=frame.shape).astype(np.int16)
+            for y, x in (positions + i * velocities) % [height - side,
+                                                         width - side]:
+                frame[int(y):int(y) + side, int(x):int(x) + side] = 255
+            frame = np.clip(frame, 0, 255).astype(np.uint8)
+            writer.write_frame(Image(plane_buffers=[frame.tobytes()],
+                                     pix_fmt="gray", size=(width, height)),
+                               float(i) / fps)
+    finally:
+        writer.close()
+    os.replace(tmp, filename)
+    return filename
+
+
+def grid_masks(shape, n):
+    """
+    Returns n ROI masks tiling the frame in a grid.
+    """
+    height, width = shape
+    columns = int(np.ceil(np.sqrt(n)))
+    rows = int(np.ceil(n / float(columns)))
+    masks = []
+    for i in range(n):
+        y, x = divmod(i, columns)
+        mask = np.zeros(shape, dtype=bool)
+        mask[y * height // rows:(y + 1) * height // rows,
+             x * width // columns:(x + 1) * width // columns] = True
+        masks.append(mask)
+    return masks
+
+
+def run_case(video_file, n_rois, layout, threshold, backend, output):
+    """
+    Runs one case and returns its report entry. Meant to run in a fresh
+    process, so that peak memory belongs to the case alone.
+    """
+    with FrameSource(video_file, prefetch=1) as source:
+        next(source)
+        shape = source.frame_shape
+    masks = grid_masks(shape, n_rois)
+    stats = PipelineStats()
+    start = time.perf_counter()
+    n_frames = calculate_frame_diffs_wcall(
+        video_file, masks, LAYOUTS[layout], threshold, output=output,
+        backend=backend, stats=stats)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    summary = stats.summary()
+    case = {"video": os.path.basename(video_file),
+            "width": shape[1], "height": shape[0], "rois": n_rois,
+            "layout": layout, "frames": n_frames,
+            "seconds": round(elapsed, 4),
+            "frames_per_second": round(n_frames / elapsed, 2),
+            "peak_rss_bytes": peak_rss,
+            "stage_ms_per_frame": {
+                k: round(v * 1e3 / max(1, n_frames), 4)
+                for k, v in summary["stages"].items()},
+            "queue_depth_mean": round(summary["queue_depth_mean"], 2)}
+    case.update((k, summary[k]) for k in COUNTERS)
+    return case
+
+
+def environment(backend):
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": resolve_backend(backend)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON report file (default: print)")
+    parser.add_argument("--quick", action="store_true",
+                        help="one small case, for a smoke test")
+    parser.add_argument("--sizes", type=parse_size, nargs="+",
+                        default=["320x240", "640x480", "1280x720"],
+                        metavar="WxH")
+    parser.add_argument("--fps", type=int, nargs="+", default=[25, 60])
+    parser.add_argument("--motion", nargs="+", default=["low", "high"],
+                        choices=sorted(MOTION))
+    parser.add_argument("--rois", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--layouts", nargs="+", default=["full", "split"],
+                        choices=sorted(LAYOUTS))
+    parser.add_argument("--seconds", type=float, default=10,
+                        help="length of the synthetic videos")
+    parser.add_argument("-t", "--threshold", type=int, default=10)
+    parser.add_argument("--backend", default="auto", choices=BACKENDS)
+    parser.add_argument("--format", default="csv",
+                        help="result file format")
+    parser.add_argument("--video-dir", default=os.path.join(
+        tempfile.gettempdir(), "pixeltracking_benchmark"),
+        help="directory of the synthetic videos")
+    args = parser.parse_args(argv)
+    if args.quick:
+        for k, v in QUICK.items():
+            setattr(args, k, v)
+    sizes = [parse_size(s) if isinstance(s, str) else s for s in args.sizes]
+
+    if not os.path.isdir(args.video_dir):
+        os.makedirs(args.video_dir)
+    output = os.path.join(args.video_dir, "result." + args.format)
+    cases = []
+    context = multiprocessing.get_context("spawn")
+    for size in sizes:
+        for fps in args.fps:
+            for motion in args.motion:
+                video_file = synthetic_video(args.video_dir, size, fps,
+                                             motion, args.seconds)
+                for n_rois in args.rois:
+                    for layout in args.layouts:
+                        with concurrent.futures.ProcessPoolExecutor(
+                                max_workers=1, mp_context=context) as pool:
+                            case = pool.submit(
+                                run_case, video_file, n_rois, layout,
+                                args.threshold, args.backend,
+                                output).result()
+                        case.update(fps=fps, motion=motion)
+                        print("{0} {1} ROIs {2}: {3} frames/s".format(
+                            case["video"], n_rois, layout,
+                            case["frames_per_second"]), file=sys.stderr)
+                        cases.append(case)
+
+    report = {"environment": environment(args.backend), "cases": cases}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
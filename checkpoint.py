@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+DEFAULT_CHECKPOINT_INTERVAL = 60.0
+
+
+def masks_digest(masks):
+    """
+    Returns a digest identifying a list of ROI masks.
+    """
+    h = hashlib.sha1()
+    for m in masks:
+        m = np.asarray(m, dtype=bool)
+        h.update(str(m.shape).encode())
+        h.update(np.packbits(m.ravel()).tobytes())
+    return h.hexdigest()
+
+
+class Checkpoint(object):
+    """
+    Periodically saved state of an analysis writing to an output file,
+    allowing an interrupted run to continue where it stopped.
+
+    The state (JSON) and the reference frame are saved together in
+    <output>.checkpoint.npz, replaced atomically on every save. A checkpoint
+    is only used by runs with identical parameters.
+    """
+
+    def __init__(self, output, params, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.filename = output + ".checkpoint.npz"
+        self.params = json.loads(json.dumps(params))
+        self.interval = interval
+        self.last_save = time.time()
+
+    def due(self):
+        return time.time() - self.last_save >= self.interval
+
+    def save(self, state, oframe):
+        """
+        Saves analysis state and the reference frame.
+        """
+        tmp_filename = self.filename + ".tmp"
+        data = json.dumps({"params": self.params, "state": state})
+        with open(tmp_filename, "wb") as f:
+            np.savez(f, state=np.array(data), oframe=oframe)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        self.last_save = time.time()
+
+    def load(self):
+        """
+        Returns tuple (state, oframe) of a saved checkpoint, or None if there
+        is no checkpoint made with the same parameters.
+        """
+        if not os.path.isfile(self.filename):
+            return None
+        with np.load(self.filename) as data:
+            saved = json.loads(str(data["state"]))
+            oframe = data["oframe"]
+        if saved["params"] != self.params:
+            return None
+        return saved["state"], oframe
+
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
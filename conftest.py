@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+# Size, frame rate and length of the synthetic test video
+VIDEO_SIZE = (160, 120)
+VIDEO_FPS = 25
+VIDEO_FRAMES = 100
+
+
+def write_video(filename, size=VIDEO_SIZE, fps=VIDEO_FPS,
+                n_frames=VIDEO_FRAMES, seed=0):
+    """
+    Writes a grayscale MPEG-4 video of a bright square moving over a noisy
+    background.
+    """
+    from ffpyplayer.pic import Image
+    from ffpyplayer.writer import MediaWriter
+
+    width, height = size
+    rng = np.random.RandomState(seed)
+    background = rng.randint(0, 200, size=(height, width)).astype(np.int16)
+    side = width // 8
+    writer = MediaWriter(filename, [dict(pix_fmt_in="gray", width_in=width,
+                                         height_in=height, codec="mpeg4",
+                                         pix_fmt_out="yuv420p",
+                                         frame_rate=(fps, 1))])
+    try:
+        for i in range(n_frames):
+            frame = background + rng.randint(-3, 4, size=background.shape)
+            x = (i * 3) % (width - side)
+            frame[height // 3:height // 2, x:x + side] = 255
+            frame = np.clip(frame, 0, 255).astype(np.uint8)
+            writer.write_frame(Image(plane_buffers=[frame.tobytes()],
+                                     pix_fmt="gray", size=(width, height)),
+                               float(i) / fps)
+    finally:
+        writer.close()
+    return filename
+
+
+@pytest.fixture(scope="session")
+def video_file(tmp_path_factory):
+    pytest.importorskip("ffpyplayer")
+    return write_video(str(tmp_path_factory.mktemp("video") / "video.avi"))
+
+
+@pytest.fixture
+def masks():
+    """
+    Two overlapping ROI masks of the test video.
+    """
+    width, height = VIDEO_SIZE
+    top = np.zeros((height, width), dtype=bool)
+    top[:height // 2] = True
+    right = np.zeros((height, width), dtype=bool)
+    right[:, width // 3:] = True
+    return [top, right]
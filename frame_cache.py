@@ -0,0 +1,338 @@
+import bisect
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from frame_source import COUNTERS, FrameSource, frame_stride
+
+DEFAULT_CACHE_SIZE = 20 * 2**30
+# Video metadata kept in a cache entry
+_METADATA_KEYS = ("duration", "frame_rate", "src_vid_size")
+
+
+def cache_key(video_file, downsample=1, downsample_mode="block"):
+    """
+    Returns the name of the cache entry of a video, which changes whenever
+    the video file is modified.
+    """
+    stat = os.stat(video_file)
+    key = json.dumps([os.path.abspath(video_file), stat.st_size,
+                      stat.st_mtime, downsample, downsample_mode])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class FrameCache(object):
+    """
+    Directory of decoded grayscale videos, so that repeated analyses of
+    a video decode it only once.
+
+    An entry consists of <key>.frames with all frames as raw uint8 data,
+    memory-mapped when read, and <key>.json with timestamps and video
+    metadata. Entries are keyed by video path, size, modification time and
+    downsampling (see cache_key). When the entries take more than max_size
+    bytes, the least recently used ones are removed.
+    """
+    data_ext = ".frames"
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, video_file, downsample=1, downsample_mode="block"):
+        """
+        Returns the path (without extension) of the cache entry of a video,
+        decoding the video into a new entry if needed. Returns None if the
+        video does not fit in the cache.
+        """
+        entry = os.path.join(self.directory,
+                             cache_key(video_file, downsample,
+                                       downsample_mode))
+        if os.path.isfile(entry + ".json"):
+            # The index file time records the last use
+            os.utime(entry + ".json")
+            return entry
+        if not self._build(entry, video_file, downsample, downsample_mode):
+            return None
+        self.evict(keep=entry)
+        return entry
+
+    def _build(self, entry, video_file, downsample, downsample_mode):
+        tmp = "{0}.{1}.tmp".format(entry, os.getpid())
+        times = []
+        source = FrameSource(video_file, downsample=downsample,
+                             downsample_mode=downsample_mode)
+        try:
+            with open(tmp + ".frames", "wb") as f:
+                for frame, t in source:
+                    if not times and self._too_large(source, frame.size):
+                        return False
+                    f.write(np.ascontiguousarray(frame).data)
+                    times.append(t)
+            if not times:
+                return False
+            metadata = source.get_metadata()
+            index = {"video_file": video_file,
+                     "frame_shape": list(source.frame_shape),
+                     "times": times,
+                     "metadata": {k: metadata[k] for k in _METADATA_KEYS}}
+            with open(tmp + ".json", "w") as f:
+                json.dump(index, f)
+            os.replace(tmp + ".frames", entry + ".frames")
+            os.replace(tmp + ".json", entry + ".json")
+            return True
+        finally:
+            source.close()
+            for ext in (".frames", ".json"):
+                if os.path.isfile(tmp + ext):
+                    os.remove(tmp + ext)
+
+    def _too_large(self, source, frame_bytes):
+        """
+        Tells whether frame_bytes for every frame delivered by source would
+        exceed the size limit.
+        """
+        metadata = source.get_metadata()
+        if metadata is None:
+            return False
+        num, den = metadata["frame_rate"]
+        if not num or not den:
+            return False
+        n_frames = metadata["duration"] * num / den / source.stride
+        return n_frames * frame_bytes > self.max_size
+
+    def entries(self):
+        """
+        Returns list of (last use, size, entry) of complete entries.
+        """
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or ".tmp" in name:
+                continue
+            entry = os.path.join(self.directory, name[:-len(".json")])
+            try:
+                size = (os.path.getsize(entry + self.data_ext)
+                        + os.path.getsize(entry + ".json"))
+                result.append((os.path.getmtime(entry + ".json"), size,
+                               entry))
+            except OSError:
+                continue
+        return result
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries (except keep) until the cache
+        is within its size limit.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            for ext in (".json", self.data_ext):
+                if os.path.isfile(entry + ext):
+                    os.remove(entry + ext)
+            total -= size
+
+
+class CachedFrameSource(object):
+    """
+    Frame source (see FrameSource) reading a cache entry. Frames are
+    (height, width) views of the memory-mapped entry; frames_decoded counts
+    frames read from the entry.
+    """
+
+    def __init__(self, entry, sample_rate=None):
+        with open(entry + ".json") as f:
+            index = json.load(f)
+        self.metadata = dict(index["metadata"])
+        for k in ("frame_rate", "src_vid_size"):
+            self.metadata[k] = tuple(self.metadata[k])
+        self.frame_shape = tuple(index["frame_shape"])
+        self.times = index["times"]
+        self.frames = np.memmap(entry + ".frames", dtype=np.uint8, mode="r",
+                                shape=(len(self.times),) + self.frame_shape)
+        num, den = self.metadata["frame_rate"]
+        self.fps = float(num) / den if num and den else None
+        self.stride = frame_stride((num, den), sample_rate)
+        self.position = 0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.position < len(self.times):
+            i = self.position
+            self.position += 1
+            t = self.times[i]
+            self.counters["frames_decoded"] += 1
+            if self.stride > 1 and int(round(t*self.fps)) % self.stride:
+                self.counters["frames_skipped"] += 1
+                continue
+            return self.frames[i], t
+        raise StopIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_metadata(self):
+        return self.metadata
+
+    def queue_depth(self):
+        return 0
+
+    def seek(self, t):
+        self.counters["seeks"] += 1
+        self.position = bisect.bisect_left(self.times, t)
+
+    def close(self):
+        self.frames = None
+
+
+class DiffCache(FrameCache):
+    """
+    Directory of bit-packed frame differences, so that results for other
+    ROIs are computed without decoding and differencing the video again.
+
+    An entry consists of <key>.masks with the packed difference of every
+    result row and <key>.json with the Range and Time of the rows and the
+    analysis parameters. Entries are keyed by video path, size,
+    modification time and the parameters (threshold, ranges, downsampling,
+    sampling), which are checked again when an entry is loaded.
+    """
+    data_ext = ".masks"
+
+    def entry(self, video_file, params):
+        """
+        Returns the path (without extension) of the entry for a video
+        analysed with given parameters (a JSON serializable dict).
+        """
+        stat = os.stat(video_file)
+        key = json.dumps([os.path.abspath(video_file), stat.st_size,
+                          stat.st_mtime, params], sort_keys=True)
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest())
+
+    def load(self, entry, params):
+        """
+        Returns CachedDiffs of an entry, or None if there is no entry made
+        with the same parameters.
+        """
+        if not os.path.isfile(entry + ".json"):
+            return None
+        with open(entry + ".json") as f:
+            index = json.load(f)
+        if index["params"] != json.loads(json.dumps(params)):
+            return None
+        os.utime(entry + ".json")
+        return CachedDiffs(entry, index)
+
+    def recorder(self, entry, params, source):
+        """
+        Returns a DiffRecorder of an entry for the frames of source, or None
+        if the differences of the whole video would not fit in the cache.
+        """
+        # Frame shape and metadata are known once the first frame is
+        # decoded
+        source.get_metadata()
+        if source.frame_shape is None:
+            return None
+        height, width = source.frame_shape
+        if self._too_large(source, (height*width + 7) // 8):
+            return None
+        return DiffRecorder(self, entry, params)
+
+
+class DiffRecorder(object):
+    """
+    Writes frame differences of an analysis into a DiffCache entry, which
+    becomes visible only when the recording is committed. A recording
+    growing beyond the size limit of the cache is discarded, and rows is
+    then empty.
+    """
+
+    def __init__(self, cache, entry, params):
+        self.cache = cache
+        self.entry = entry
+        self.params = params
+        self.tmp = "{0}.{1}.tmp".format(entry, os.getpid())
+        self.file = open(self.tmp + cache.data_ext, "wb")
+        self.frame_shape = None
+        self.rows = []
+        self.size = 0
+        self.discarded = False
+
+    def append(self, crange, t, frame_diff):
+        if self.discarded:
+            return
+        bits = np.packbits(frame_diff)
+        self.size += bits.nbytes
+        if self.size > self.cache.max_size:
+            self.discard()
+            return
+        self.frame_shape = frame_diff.shape
+        self.file.write(bits.data)
+        self.rows.append([int(crange), t])
+
+    def commit(self, duration):
+        self.file.close()
+        index = {"params": self.params,
+                 "frame_shape": self.frame_shape and list(self.frame_shape),
+                 "duration": duration,
+                 "rows": self.rows}
+        with open(self.tmp + ".json", "w") as f:
+            json.dump(index, f)
+        os.replace(self.tmp + self.cache.data_ext,
+                   self.entry + self.cache.data_ext)
+        os.replace(self.tmp + ".json", self.entry + ".json")
+        self.cache.evict(keep=self.entry)
+
+    def discard(self):
+        self.discarded = True
+        self.rows = []
+        self.file.close()
+        for ext in (self.cache.data_ext, ".json"):
+            if os.path.isfile(self.tmp + ext):
+                os.remove(self.tmp + ext)
+
+
+class CachedDiffs(object):
+    """
+    Iterator over (crange, t, frame_diff) of a DiffCache entry, frame_diff
+    being a boolean (height, width) array. Like a frame source, it counts
+    the differences read as frames_decoded in counters.
+    """
+
+    def __init__(self, entry, index):
+        self.entry = entry
+        self.params = index["params"]
+        self.duration = index["duration"]
+        self.rows = index["rows"]
+        self.frame_shape = None
+        if index["frame_shape"] is not None:
+            self.frame_shape = tuple(index["frame_shape"])
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def queue_depth(self):
+        return 0
+
+    def __iter__(self):
+        if not self.rows:
+            return
+        n_pixels = self.frame_shape[0] * self.frame_shape[1]
+        packed = np.memmap(self.entry + DiffCache.data_ext, dtype=np.uint8,
+                           mode="r", shape=(len(self.rows),
+                                            (n_pixels + 7) // 8))
+        for (crange, t), bits in zip(self.rows, packed):
+            frame_diff = np.unpackbits(bits, count=n_pixels).view(bool)
+            self.counters["frames_decoded"] += 1
+            yield crange, t, frame_diff.reshape(self.frame_shape)
@@ -1,25 +1,60 @@
-import numpy as np
-import pandas as pd
+import bisect
+import concurrent.futures
+import itertools
+
+import os
 import time
 
-from ffpyplayer.player import MediaPlayer
+import numpy as np
+
+from checkpoint import Checkpoint, masks_digest
+from frame_cache import (FrameCache, CachedFrameSource, DiffCache,
+                         DEFAULT_CACHE_SIZE)
+from frame_source import FrameSource, DEFAULT_PREFETCH, frame_stride
+from kernels import (ThresholdSweep, FrameBlock, default_block_frames,
+                     resolve_backend, single_threshold)
+from resample import downsample_mask, downsampled_shape, resize_mask
+from results import (ResultBuffer, ArraySink, DEFAULT_BLOCK_SIZE,
+                     DEFAULT_HISTOGRAM_BINS, HistogramArray, HistogramSink,
+                     histogram_record, open_sink, sink_class)
+from roi_engine import ROIEngine
+from roi_geometry import ROIGeometry
+from roi_masks import unpack_mask
+from stats import DEFAULT_PROGRESS_INTERVAL, PipelineStats, ProgressMeter
+
+# Initial distance (in seconds) by which a chunk worker seeks before its
+# start to find the reference frame preceding it.
+SEEK_PREROLL = 2.0
+
+# ROI engine of a chunk worker process
+_worker_engine = None
 
 
-def get_frame(player, t0=0):
+class AnalysisCancelled(Exception):
     """
-    Reads next frame from the stream, ensuring timestamp after t0.
+    Raised when an analysis stops because its cancel event was set.
     """
-    while True:
-        frame, val = player.get_frame()
-        if val == 'eof':
-            return None
-        elif frame is None:
-            time.sleep(0.01)
-        else:
-            img, t = frame
-            if t < t0:
-                continue
-            return img, t
+
+
+def column_names(n_rois, pixel_diff_threshold=None):
+    """
+    Returns names of result columns. For a list of thresholds (a sweep)
+    the Overall and ROI columns are repeated for every threshold, with the
+    threshold appended to their names (e.g. "ROI0_10").
+    """
+    names = ["Overall"] + ["ROI{0}".format(j) for j in range(n_rois)]
+    if not is_sweep(pixel_diff_threshold):
+        return ["Range", "Time"] + names
+    return ["Range", "Time"] + ["{0}_{1}".format(name, th)
+                                for th in pixel_diff_threshold
+                                for name in names]
+
+
+def is_sweep(pixel_diff_threshold):
+    """
+    Tells whether a threshold argument is a list of thresholds.
+    """
+    return np.ndim(pixel_diff_threshold) > 0
 
 
 def update_range(crange, range_selected):
@@ -33,46 +68,219 @@ def update_range(crange, range_selected):
     return crange
 
 
-def calculate_frame_diffs_wcall(video_file, masks, cut_ranges,
-                                pixel_diff_threshold=10, callback=None,
-                                sec_callback=5):
+def probe_video(video_file):
     """
-    Calculates frame differences for a video file.
+    Returns metadata of a video file (see FrameSource.get_metadata), or None
+    if the video has no frames.
     """
-    distances = []
-    column_names = (["Range", "Time", "Overall"]
-                    + ["ROI{0}".format(j) for j, _ in enumerate(masks)])
-    masks = [m.flatten() for m in masks]
-    distances.append([-1, -1, 1] + [np.mean(m) for m in masks])
+    source = FrameSource(video_file, prefetch=1)
+    try:
+        if next(source, None) is None:
+            return None
+        return source.get_metadata()
+    finally:
+        source.close()
+
+
+def scaled_frame_shape(video_file, downsample):
+    """
+    Returns (height, width) of frames scaled by the decoder (see
+    FrameSource) by downsample, or None if the video has no frames.
+    """
+    source = FrameSource(video_file, prefetch=1, downsample=downsample,
+                         downsample_mode="decoder")
+    try:
+        if next(source, None) is None:
+            return None
+        return source.frame_shape
+    finally:
+        source.close()
+
+
+def analysed_masks(masks, downsample=1, shape=None):
+    """
+    Returns boolean ROI masks at the size of analysed frames, from masks of
+    the video frame size (arrays or PackedMasks) or ROIGeometry. Masks are
+    reduced by downsample, or, when shape (of frames scaled by the
+    decoder) is given, sampled at shape.
+    """
+    small_masks = []
+    for m in masks:
+        if isinstance(m, ROIGeometry):
+            # Geometry is rasterized at the analysed resolution itself,
+            # which is exact where downsampling a full resolution mask is
+            # not
+            m = m.rasterize(shape) if shape is not None \
+                else m.rasterize(factor=downsample)
+        else:
+            m = unpack_mask(m)
+            if shape is None or \
+                    tuple(shape) == downsampled_shape(m.shape, downsample):
+                m = downsample_mask(m, downsample)
+            else:
+                m = resize_mask(m, shape)
+        small_masks.append(m)
+    return small_masks
+
+
+def open_source(video_file, prefetch=DEFAULT_PREFETCH, downsample=1,
+                downsample_mode="block", sample_rate=None, skip_frames=None,
+                cache_entry=None):
+    """
+    Opens a FrameSource, or a CachedFrameSource when cache_entry (see
+    FrameCache.get) is given.
+    """
+    if cache_entry is not None:
+        return CachedFrameSource(cache_entry, sample_rate)
+    return FrameSource(video_file, prefetch=prefetch, downsample=downsample,
+                       downsample_mode=downsample_mode,
+                       sample_rate=sample_rate, skip_frames=skip_frames)
+
+
+def seek_before(source, start, preroll=SEEK_PREROLL):
+    """
+    Positions the frame source at time start.
+
+    Returns tuple (oframe, frames) where oframe is the last frame before
+    start (or None) and frames iterates over frames from start on.
+    """
+    while True:
+        source.seek(max(0, start - preroll))
+        oframe = None
+        for frame in source:
+            if frame[1] >= start:
+                break
+            oframe = frame[0]
+        else:
+            return oframe, iter(())
+        if oframe is not None or start - preroll <= 0:
+            return oframe, itertools.chain([frame], source)
+        # Seek landed after start, retry from further back
+        preroll *= 2
 
-    player = MediaPlayer(video_file, thread_lib="SDL",
-                         ff_opts={"out_fmt": "gray8", "an": True, "sn": True})
 
-    frame = get_frame(player)
+def analyse_frames(source, engine, cut_ranges, distances,
+                   pixel_diff_threshold=10, callback=None, sec_callback=5,
+                   start=0, stop=None, checkpoint=None, resume=None,
+                   recorder=None, histograms=None, block_frames=None,
+                   backend="auto", stats=None, cancel=None, progress=None):
+    """
+    Appends frame differences of selected ranges read from a frame source
+    to distances (a list or ResultBuffer). Returns the last frame
+    difference (or None).
+
+    pixel_diff_threshold -- threshold, or list of thresholds to compute
+                            results for all of them (see ThresholdSweep)
+    start, stop -- limit processing to frames with timestamps in
+                   [start, stop); rows are identical to those of a run over
+                   the whole video
+    checkpoint -- Checkpoint periodically saving the analysis state
+                  (distances must be a ResultBuffer)
+    resume -- tuple (state, oframe) loaded from a checkpoint to continue
+              from
+    recorder -- DiffRecorder to which the difference of every row is
+                written
+    histograms -- HistogramArray or HistogramSink receiving per-ROI
+                  histograms of the absolute difference of every row
+    block_frames -- number of frames processed together (see FrameBlock),
+                    by default chosen from the frame size; 1 processes
+                    frames one by one. Threshold sweeps are always
+                    processed frame by frame.
+    backend -- kernel backend, see kernels.resolve_backend; the compiled
+               backend processes frames one by one and does not apply to
+               threshold sweeps
+    stats -- PipelineStats collecting stage times and source counters
+    cancel -- threading.Event checked after every frame; when it is set,
+              collected rows are appended, a checkpoint is saved (if
+              checkpoint is given) and AnalysisCancelled is raised
+    progress -- ProgressMeter updated with every row
+    """
+    frame = next(source, None)
     if frame is None:
-        return pd.DataFrame(distances, columns=column_names)
-    img, t = frame
+        return
 
-    metadata = player.get_metadata()
-    duration, vid_size = metadata["duration"], metadata["src_vid_size"]
-    vid_size = (vid_size[1], vid_size[0])
+    duration = source.get_metadata()["duration"]
+    vid_size = source.frame_shape
+    if engine.shape is not None and tuple(engine.shape) != vid_size:
+        raise ValueError("ROI mask size {0} does not match video frame size "
+                         "{1}".format(engine.shape, vid_size))
 
-    img, t = frame
-    oframe = np.asarray(img.to_memoryview(keep_align=False)[0], dtype=np.uint8)
+    oframe, t = frame
+    if block_frames is None:
+        block_frames = default_block_frames(vid_size)
+    backend = resolve_backend(backend)
+    block = None
+    if is_sweep(pixel_diff_threshold):
+        measure = ThresholdSweep(vid_size, pixel_diff_threshold, engine)
+    elif block_frames > 1 and backend == "numpy":
+        block = FrameBlock(vid_size, pixel_diff_threshold, engine,
+                           block_frames)
+    else:
+        measure = single_threshold(vid_size, pixel_diff_threshold, engine,
+                                   backend)
+    if stats is not None:
+        (measure if block is None else block).stats = stats
 
     range_end = [r*duration for r in cut_ranges[0]]
     range_selected = [True] + cut_ranges[1]
+    if progress is not None:
+        progress.start(duration)
 
-    t0 = 0
     last_callback = 0
     crange = 0
+    frames = source
+    measured = False
+    last_diff = None
 
-    while True:
-        # Get next frame
-        frame = get_frame(player, t0)
-        if frame is None:
+    def flush_block():
+        # Emits the rows of the collected frames like the frame by frame
+        # branch below
+        nonlocal last_callback, last_diff
+        if not block.n:
+            return
+        rows, kernel = block.flush()
+        distances.extend(rows)
+        if stats is not None:
+            stats.rows += len(rows)
+        for i, (row_range, row_t) in enumerate(rows[:, :2].tolist()):
+            if stats is not None:
+                start = time.perf_counter()
+            if recorder is not None:
+                recorder.append(row_range, row_t, kernel.changed[i])
+            if histograms is not None:
+                histograms.append(row_range, row_t, engine.histograms(
+                    kernel.absdiff[i], histograms.bins))
+            if stats is not None:
+                start = stats.add("output", start)
+            if (callback is not None
+                    and (row_t - last_callback) >= sec_callback):
+                last_callback = row_t
+                callback(row_t/duration, kernel.changed[i].copy())
+            if stats is not None:
+                stats.add("callback", start)
+        last_diff = kernel.changed[len(rows) - 1]
+        if progress is not None:
+            progress.update(int(row_range), row_t, len(rows))
+
+    if resume is not None:
+        state, oframe = resume
+        oframe = oframe.reshape(vid_size)
+        crange = state["crange"]
+        last_callback = state["last_callback"]
+        _, frames = seek_before(source, state["t"])
+        frames = itertools.dropwhile(lambda frame: frame[1] <= state["t"],
+                                     frames)
+    elif start > 0:
+        crange = bisect.bisect_left(range_end, start)
+        oframe, frames = seek_before(source, start)
+    if block is not None and oframe is not None:
+        block.start(oframe)
+    if stats is not None:
+        frames = stats.read(source, frames)
+
+    for cframe, t in frames:
+        if stop is not None and t >= stop:
             break
-        img, t = frame
 
         # Update current range
         if t >= range_end[crange]:
@@ -81,34 +289,477 @@ def calculate_frame_diffs_wcall(video_file, masks, cut_ranges,
                 break
             if nrange > crange:
                 if t < range_end[nrange-1]:
-                    player.seek(range_end[nrange-1], relative=False)
+                    if block is not None:
+                        flush_block()
+                    source.seek(range_end[nrange-1])
                     oframe = None
-                    t0 = range_end[nrange-1]
                     continue
                 crange = nrange
 
         # Calculate frame difference
-        cframe = np.asarray(img.to_memoryview(keep_align=False)[0])
-        if oframe is not None:
-            frame_diff = ((cframe - oframe > pixel_diff_threshold) &
-                          (oframe - cframe > pixel_diff_threshold))
-            distances.append([crange, t, np.mean(frame_diff)]
-                             + [np.mean(frame_diff & mask)
-                                for mask in masks])
-            # Callback
+        if block is not None:
+            if oframe is None:
+                block.start(cframe)
+            elif block.add(cframe, crange, t):
+                flush_block()
+        elif oframe is not None:
+            distances.append([crange, t] + measure(cframe, oframe))
+            measured = True
+            if stats is not None:
+                stats.rows += 1
+                start = time.perf_counter()
+            if recorder is not None:
+                recorder.append(crange, t, measure.frame_diff())
+            if histograms is not None:
+                histograms.append(crange, t, engine.histograms(
+                    measure.kernel.absdiff, histograms.bins))
+            if stats is not None:
+                start = stats.add("output", start)
+            # Callback (the buffer of frame_diff is reused for the next
+            # frame)
             if callback is not None and (t - last_callback) >= sec_callback:
                 last_callback = t
-                callback(t/duration, frame_diff.reshape(vid_size))
+                callback(t/duration, measure.frame_diff().copy())
+            if stats is not None:
+                stats.add("callback", start)
+            if progress is not None:
+                progress.update(crange, t)
+        # Frames reference their decoded pictures (see DecodedFrame), so
+        # keeping the reference frame keeps its buffer valid
         oframe = cframe
-        t0 = t
 
-    player.close_player()
+        cancelled = cancel is not None and cancel.is_set()
+        if cancelled and block is not None:
+            flush_block()
+        if checkpoint is not None and (cancelled or checkpoint.due()):
+            if block is not None:
+                flush_block()
+            distances.flush()
+            checkpoint.save({"t": t, "crange": crange,
+                             "last_callback": last_callback,
+                             "rows": distances.rows,
+                             "sink": distances.sink.checkpoint(),
+                             "histograms": histograms and
+                             histograms.checkpoint()}, oframe)
+        if cancelled:
+            raise AnalysisCancelled()
+
+    if stats is not None:
+        stats.finish(source)
+    if block is not None:
+        flush_block()
+        if last_diff is not None:
+            return last_diff.copy()
+    elif measured:
+        return measure.frame_diff().copy()
+
+
+def replay_diffs(diffs, engine, distances, callback=None, sec_callback=5,
+                 stats=None, cancel=None, progress=None):
+    """
+    Appends rows computed from cached frame differences (CachedDiffs) to
+    distances, like analyse_frames but without reading the video. Returns
+    the last frame difference (or None). Reading the cache is timed as
+    decode by stats. Raises AnalysisCancelled when cancel is set. progress
+    (a ProgressMeter) is updated with every row.
+    """
+    if (engine.shape is not None and diffs.frame_shape is not None
+            and tuple(engine.shape) != diffs.frame_shape):
+        raise ValueError("ROI mask size {0} does not match video frame size "
+                         "{1}".format(engine.shape, diffs.frame_shape))
+    last_callback = 0
+    frame_diff = None
+    if progress is not None:
+        progress.start(diffs.duration)
+    if stats is None:
+        rows = diffs
+    else:
+        rows = stats.read(diffs, diffs)
+    for crange, t, frame_diff in rows:
+        if cancel is not None and cancel.is_set():
+            raise AnalysisCancelled()
+        if stats is not None:
+            start = time.perf_counter()
+        distances.append([crange, t] + engine.fractions(frame_diff))
+        if stats is not None:
+            stats.rows += 1
+            start = stats.add("aggregate", start)
+        if callback is not None and (t - last_callback) >= sec_callback:
+            last_callback = t
+            callback(t/diffs.duration, frame_diff)
+        if stats is not None:
+            stats.add("callback", start)
+        if progress is not None:
+            progress.update(crange, t)
+    if stats is not None:
+        stats.finish(diffs)
+    return frame_diff
+
+
+def plan_chunks(cut_ranges, duration, chunk_duration=None):
+    """
+    Splits a video into consecutive time intervals (start, stop) which may be
+    analysed independently. Intervals end at the ends of selected ranges and
+    selected ranges longer than chunk_duration seconds are split further.
+    The last interval has stop equal to None.
+    """
+    cutpoints = [r*duration for r in cut_ranges[0]]
+    splits = []
+    for i, selected in enumerate(cut_ranges[1]):
+        if not selected:
+            continue
+        a, b = cutpoints[i], cutpoints[i+1]
+        points = [b]
+        if chunk_duration:
+            n = int(np.ceil((b - a) / chunk_duration))
+            points = [a + k*chunk_duration for k in range(1, n)] + points
+        for p in points:
+            if p > (splits[-1] if splits else 0):
+                splits.append(p)
+    starts = [0] + splits[:-1]
+    stops = splits[:-1] + [None]
+    return list(zip(starts, stops))
+
+
+def _init_chunk_worker(masks):
+    global _worker_engine
+    _worker_engine = ROIEngine(masks)
+
+
+def _analyse_chunk(video_file, cut_ranges, start, stop, pixel_diff_threshold,
+                   prefetch, downsample, downsample_mode, sample_rate,
+                   skip_frames, cache_entry, histogram_record,
+                   block_frames, backend, collect_stats):
+    sink = ArraySink(column_names(_worker_engine.n_rois,
+                                  pixel_diff_threshold))
+    distances = ResultBuffer(sink.columns, sink)
+    histograms = None
+    if histogram_record is not None:
+        histograms = HistogramArray(histogram_record)
+    stats = None
+    if collect_stats:
+        stats = PipelineStats()
+        distances.stats = stats
+    source = open_source(video_file, prefetch, downsample, downsample_mode,
+                         sample_rate, skip_frames, cache_entry)
+    try:
+        frame_diff = analyse_frames(source, _worker_engine, cut_ranges,
+                                    distances, pixel_diff_threshold,
+                                    start=start, stop=stop,
+                                    histograms=histograms,
+                                    block_frames=block_frames,
+                                    backend=backend, stats=stats)
+    finally:
+        source.close()
+    distances.close()
+    return (sink.array(), frame_diff,
+            histograms and histograms.array(),
+            stats and stats.summary())
+
+
+def analyse_chunks(video_file, masks, cut_ranges, distances,
+                   pixel_diff_threshold=10, callback=None, workers=None,
+                   chunk_duration=None, prefetch=DEFAULT_PREFETCH,
+                   downsample=1, downsample_mode="block", sample_rate=None,
+                   skip_frames=None, cache_entry=None, histograms=None,
+                   block_frames=None, backend="auto", stats=None,
+                   cancel=None, progress=None):
+    """
+    Appends frame differences to distances (a list or ResultBuffer),
+    analysing chunks of the video (see plan_chunks) in parallel worker
+    processes. Masks must match the downsampled frame size. Workers read
+    frames from cache_entry when it is given. Per-ROI histograms are
+    written to histograms when it is given (see analyse_frames). Stats of
+    the workers are merged into stats as their chunks complete. When
+    cancel (a threading.Event) is set, chunks which have not started are
+    cancelled and AnalysisCancelled is raised once running chunks end.
+    progress (a ProgressMeter) is updated as chunks complete.
+    """
+    video_metadata = probe_video(video_file)
+    if video_metadata is None:
+        return
+    duration = video_metadata["duration"]
+
+    chunks = plan_chunks(cut_ranges, duration, chunk_duration)
+    done = 0
+    if progress is not None:
+        progress.start(duration)
+        # Rates are measured from the submission of the chunks
+        progress.update(0, 0, 0, done)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_chunk_worker,
+            initargs=(masks,)) as pool:
+        futures = [pool.submit(_analyse_chunk, video_file, cut_ranges,
+                               start, stop, pixel_diff_threshold, prefetch,
+                               downsample, downsample_mode, sample_rate,
+                               skip_frames, cache_entry,
+                               histograms and histograms.record,
+                               block_frames, backend, stats is not None)
+                   for start, stop in chunks]
+        for (start, stop), f in zip(chunks, futures):
+            rows, frame_diff, histogram_rows, summary = f.result()
+            distances.extend(rows)
+            if histograms is not None:
+                histograms.write(histogram_rows)
+            if stats is not None:
+                stats.merge(summary)
+            if callback is not None and frame_diff is not None:
+                callback(1 if stop is None else stop/duration, frame_diff)
+            if progress is not None and len(rows):
+                done += progress.selected_time(
+                    start, duration if stop is None else stop)
+                progress.update(int(rows[-1][0]), rows[-1][1], len(rows),
+                                done)
+            if cancel is not None and cancel.is_set():
+                for f in futures:
+                    f.cancel()
+                raise AnalysisCancelled()
+
+
+def calculate_frame_diffs_wcall(video_file, masks, cut_ranges,
+                                pixel_diff_threshold=10, callback=None,
+                                sec_callback=5, prefetch=DEFAULT_PREFETCH,
+                                workers=1, chunk_duration=None, output=None,
+                                block_size=DEFAULT_BLOCK_SIZE,
+                                checkpoint_interval=None, resume=False,
+                                downsample=1, downsample_mode="block",
+                                sample_rate=None, skip_frames=None,
+                                cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+                                diff_cache_dir=None, histogram_output=None,
+                                histogram_bins=DEFAULT_HISTOGRAM_BINS,
+                                block_frames=None, backend="auto",
+                                stats=None, cancel=None,
+                                progress_callback=None,
+                                progress_interval=DEFAULT_PROGRESS_INTERVAL):
+    """
+    Calculates frame differences for a video file.
+
+    Returns a DataFrame with the results, or, when output is given, the
+    number of frames written to the output file.
+
+    masks -- boolean ROI masks (arrays or roi_masks.PackedMask) of the
+             video frame size, or roi_geometry.ROIGeometry
+    pixel_diff_threshold -- threshold, or list of thresholds for which
+                            results are computed in a single pass (see
+                            column_names); differences are not cached for
+                            a list
+    prefetch -- maximal number of decoded frames buffered ahead of analysis
+    workers -- number of processes analysing parts of the video in parallel
+               (None -- number of CPUs)
+    chunk_duration -- in parallel mode, maximal length (in seconds) of
+                      a part of a selected range analysed by one process
+    output -- file to which results are streamed, the format is chosen by
+              extension (.csv, .npz, .parquet, .h5; see results.SINKS)
+    block_size -- number of rows kept in memory before they are written out
+    checkpoint_interval -- when given, the state of a sequential analysis
+                           writing to output is saved every
+                           checkpoint_interval seconds (see Checkpoint)
+    resume -- continue from a checkpoint left by an interrupted run with
+              the same parameters, if there is one
+    downsample -- factor by which frames (and masks) are reduced before
+                  differencing
+    downsample_mode -- "block" (block averaging) or "decoder" (decoder
+                       scaling), see FrameSource
+    sample_rate -- when given, frames are sampled at about sample_rate Hz
+                   and each is compared with the previous sample; the rate
+                   actually used (an integer fraction of the frame rate)
+                   is recorded as effective_sample_rate in the metadata
+                   (frames dropped by skip_frames are not accounted for)
+    skip_frames -- "noref" or "nokey" to let the decoder drop
+                   non-reference frames or all frames but keyframes, see
+                   FrameSource
+    cache_dir -- directory of a FrameCache; the video is decoded into the
+                 cache once and later runs read the cached frames (not
+                 used with skip_frames)
+    cache_size -- size limit of the cache in bytes
+    diff_cache_dir -- directory of a DiffCache; frame differences of
+                      a sequential run are stored there and runs with the
+                      same parameters (except masks) only recompute ROI
+                      results from them
+    histogram_output -- .npz file to which per-ROI histograms of the
+                        absolute difference of every row are written (see
+                        HistogramSink); results are then not computed from
+                        cached differences
+    histogram_bins -- number of histogram bins, a divisor of 256
+    block_frames -- number of frames differenced together (see
+                    FrameBlock), by default chosen from the frame size
+    backend -- "numpy", "numba" (compiled kernel, requires Numba) or
+               "auto" (compiled kernel when Numba is installed); results
+               are identical
+    stats -- PipelineStats which is filled with stage times and frame
+             source counters (see stats.PipelineStats); its callback, if
+             any, is called periodically during the analysis
+    cancel -- threading.Event stopping the analysis when set; the frame
+              source is closed and AnalysisCancelled is raised. Rows up to
+              the cancellation are written out, with a checkpoint when
+              checkpoints are enabled, so that a resumed run continues
+              from there.
+    progress_callback -- called with a progress record (frames, frame
+                         rates, realtime factor, ETA and current range, see
+                         stats.ProgressMeter) every progress_interval
+                         seconds and when the analysis ends; unlike
+                         callback, it is called in wall-clock time, so it
+                         also shows a slow analysis
+    """
+    if histogram_bins < 1 or 256 % histogram_bins:
+        raise ValueError("Number of histogram bins must divide 256")
+    if is_sweep(pixel_diff_threshold):
+        pixel_diff_threshold = list(pixel_diff_threshold)
+    scaled_shape = None
+    if downsample > 1 and downsample_mode == "decoder":
+        # The decoder's scaler may round the downsampled size
+        scaled_shape = scaled_frame_shape(video_file, downsample)
+    small_masks = analysed_masks(masks, downsample, scaled_shape)
+    columns = column_names(len(masks), pixel_diff_threshold)
+    engine = ROIEngine(small_masks)
+    progress = None
+    if progress_callback is not None:
+        progress = ProgressMeter(progress_callback, progress_interval)
+        progress.select(cut_ranges)
+    metadata = {"video_file": video_file,
+                "pixel_diff_threshold": pixel_diff_threshold,
+                "cutpoints": [float(c) for c in cut_ranges[0]],
+                "selected_ranges": [bool(s) for s in cut_ranges[1]],
+                "mask_coverage": engine.coverage(),
+                "downsample": downsample,
+                "downsample_mode": downsample_mode,
+                "sample_rate": sample_rate,
+                "skip_frames": skip_frames}
+    if sample_rate is not None:
+        video_metadata = probe_video(video_file)
+        if video_metadata is not None:
+            frame_rate = video_metadata["frame_rate"]
+            stride = frame_stride(frame_rate, sample_rate)
+            metadata["effective_sample_rate"] = \
+                float(frame_rate[0]) / frame_rate[1] / stride
+
+    diffs = None
+    diff_entry = None
+    recorder = None
+    if diff_cache_dir is not None and not is_sweep(pixel_diff_threshold) \
+            and histogram_output is None:
+        diff_cache = DiffCache(diff_cache_dir, cache_size)
+        diff_params = {k: v for k, v in metadata.items()
+                       if k not in ("video_file", "mask_coverage")}
+        diff_entry = diff_cache.entry(video_file, diff_params)
+        diffs = diff_cache.load(diff_entry, diff_params)
+
+    cache_entry = None
+    if diffs is None and cache_dir is not None and skip_frames is None:
+        cache_entry = FrameCache(cache_dir, cache_size).get(
+            video_file, downsample, downsample_mode)
+
+    checkpoint = None
+    saved = None
+    if output is not None and checkpoint_interval is not None:
+        if workers != 1 or not sink_class(output).resumable:
+            raise ValueError("Checkpoints require sequential analysis and "
+                             "a resumable output format")
+        stat = os.stat(video_file)
+        full_masks = [m.rasterize() if isinstance(m, ROIGeometry)
+                      else unpack_mask(m) for m in masks]
+        params = dict(metadata, output=output,
+                      masks=masks_digest(full_masks),
+                      video_size=stat.st_size, video_mtime=stat.st_mtime)
+        if histogram_output is not None:
+            params.update(histogram_output=histogram_output,
+                          histogram_bins=histogram_bins)
+        checkpoint = Checkpoint(output, params, checkpoint_interval)
+        if resume and diffs is None:
+            saved = checkpoint.load()
+    # Differences of resumed or parallel runs are not recorded
+    record_diffs = (diff_cache_dir is not None and diff_entry is not None
+                    and diffs is None
+                    and not is_sweep(pixel_diff_threshold)
+                    and workers == 1 and saved is None)
+
+    if output is None:
+        sink = ArraySink(columns)
+    elif saved is not None:
+        sink = open_sink(output, columns, metadata, resume=saved[0]["sink"])
+    else:
+        sink = open_sink(output, columns, metadata)
+    distances = ResultBuffer(columns, sink, block_size)
+    distances.stats = stats
+
+    histograms = None
+    if histogram_output is not None:
+        record = histogram_record(engine.n_rois, histogram_bins,
+                                  max(engine.roi_pixels() + [0]))
+        histogram_metadata = dict(
+            metadata, bins=histogram_bins,
+            edges=list(range(0, 257, 256 // histogram_bins)),
+            roi_pixels=engine.roi_pixels())
+        histograms = HistogramSink(
+            histogram_output, record, histogram_metadata,
+            resume=saved and saved[0].get("histograms"))
+
+    try:
+        if saved is not None:
+            distances.rows = saved[0]["rows"]
+        elif sink.coverage_row:
+            coverage = [1] + engine.coverage()
+            n_thresholds = (len(columns) - 2) // len(coverage)
+            distances.append([-1, -1] + coverage*n_thresholds)
+        if diffs is not None:
+            replay_diffs(diffs, engine, distances, callback, sec_callback,
+                         stats, cancel, progress)
+        elif workers != 1:
+            analyse_chunks(video_file, small_masks, cut_ranges, distances,
+                           pixel_diff_threshold, callback, workers,
+                           chunk_duration, prefetch, downsample,
+                           downsample_mode, sample_rate, skip_frames,
+                           cache_entry, histograms, block_frames,
+                           backend, stats, cancel, progress)
+        else:
+            source = open_source(video_file, prefetch, downsample,
+                                 downsample_mode, sample_rate, skip_frames,
+                                 cache_entry)
+            try:
+                if record_diffs:
+                    recorder = diff_cache.recorder(diff_entry, diff_params,
+                                                   source)
+                analyse_frames(source, engine, cut_ranges, distances,
+                               pixel_diff_threshold, callback, sec_callback,
+                               checkpoint=checkpoint, resume=saved,
+                               recorder=recorder, histograms=histograms,
+                               block_frames=block_frames, backend=backend,
+                               stats=stats, cancel=cancel,
+                               progress=progress)
+                if recorder is not None and recorder.rows:
+                    recorder.commit(source.get_metadata()["duration"])
+                    recorder = None
+            finally:
+                source.close()
+    except BaseException:
+        if checkpoint is None:
+            distances.close()
+            if histograms is not None:
+                histograms.close()
+        else:
+            # Leave the output as of the last checkpoint for resuming
+            sink.abort()
+            if histograms is not None:
+                histograms.abort()
+        raise
+    finally:
+        if recorder is not None:
+            recorder.discard()
+    distances.close()
+    if histograms is not None:
+        histograms.close()
+    if checkpoint is not None:
+        checkpoint.remove()
+    if progress is not None:
+        progress.finish()
 
-    return pd.DataFrame(distances, columns=column_names)
+    if output is None:
+        return sink.data_frame()
+    return distances.rows - int(sink.coverage_row)
 
 
 if __name__ == "__main__":
     res = calculate_frame_diffs_wcall("LABIRYNT_03_78_044.avi", [],
                                       ([0, 0.5, 0.6, 0.66, 0.7, 0.8, 1], [False, True, True, False, True, False]),
-                                      callback=lambda p, _: print(p))
-    res.to_csv("out.csv", index=False)
+                                      callback=lambda p, _: print(p),
+                                      output="out.csv")
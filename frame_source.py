@@ -0,0 +1,352 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from ffpyplayer.player import MediaPlayer
+
+from resample import block_mean, downsampled_shape
+
+DEFAULT_PREFETCH = 16
+# Frame dropping must be off: the player would otherwise skip frames whenever
+# the analysis falls behind the playback clock.
+DEFAULT_FF_OPTS = {"out_fmt": "gray8", "an": True, "sn": True,
+                   "framedrop": False}
+
+# Back-off used by the decoding thread when the player has no frame ready.
+_DECODER_POLL = 0.001
+# Interval at which blocked threads re-check for seeks and shutdown.
+_WAKEUP = 0.05
+# Forward seeks shorter than this (in seconds) are done by reading through
+# decoded frames. Besides being cheaper than a real seek, this avoids frames
+# decoded ahead of the consumer being lost or delivered out of order.
+SEEK_READ_THROUGH = 2.0
+# Frames the player may still deliver from before a seek, on top of the
+# prefetch queue.
+_STALE_FRAMES = 8
+# Counters kept by frame sources (see FrameSource.counters)
+COUNTERS = ("frames_decoded", "frames_skipped", "seeks", "decoder_sleep")
+
+
+def frame_stride(frame_rate, sample_rate):
+    """
+    Returns the number of frames between samples taken at sample_rate
+    (in Hz) from a video with frame_rate given as (numerator, denominator).
+    """
+    num, den = frame_rate
+    if not sample_rate or not num or not den:
+        return 1
+    return max(1, int(round(float(num) / den / sample_rate)))
+
+
+class DecodedFrame(np.ndarray):
+    """
+    Array viewing a plane of a decoded picture. The picture (an ffpyplayer
+    Image) is referenced by the array and by every view derived from it,
+    as the plane memory is only valid while the picture exists.
+    """
+
+    def __array_finalize__(self, obj):
+        self.image = getattr(obj, "image", None)
+
+
+def plane_view(img):
+    """
+    Returns the first plane of a decoded picture as a (height, width)
+    DecodedFrame. The view strides over the decoder's aligned rows, so
+    nothing is copied.
+    """
+    width, height = img.get_size()
+    linesize = img.get_linesizes(keep_align=True)[0]
+    plane = np.frombuffer(img.to_memoryview(keep_align=True)[0],
+                          dtype=np.uint8)
+    frame = plane[:linesize*height].reshape(height, linesize)[:, :width]
+    frame = frame.view(DecodedFrame)
+    frame.image = img
+    return frame
+
+
+class FrameSource(object):
+    """
+    Iterator over decoded grayscale frames of a video file.
+
+    A background thread pulls frames out of MediaPlayer into a bounded queue
+    of at most `prefetch` frames. Iterating blocks on the queue, so the
+    consumer never sleeps while decoded frames are available and the decoder
+    never runs more than `prefetch` frames ahead.
+
+    Each item is a tuple (frame, t) where frame is a (height, width) uint8
+    array and t is the frame timestamp in seconds. Frames at the decoded
+    size are DecodedFrame views of the decoder's buffers, valid for as long
+    as they are referenced. Frames with timestamps earlier than
+    the previously returned one (or the last seek target) are skipped.
+    Reading errors reported by the player are raised as IOError.
+
+    With downsample > 1 frames are reduced by that factor, either by block
+    averaging ("block" mode) or by the decoder's scaler ("decoder" mode;
+    the scaler is set up once the first frame is decoded, and when it takes
+    effect the video is decoded again from that frame, so all delivered
+    frames come from the scaler).
+    frame_shape is the (height, width) of delivered frames. In decoder mode
+    it is the size of the scaler's output, which may differ from the
+    downsampled size by rounding (see resample.downsampled_shape); it is
+    known once get_metadata returns.
+
+    With sample_rate (in Hz) only every stride-th frame is delivered, where
+    stride follows from the nominal frame rate (see frame_stride). Frames
+    are selected by their index computed from the timestamp, so the same
+    frames are delivered regardless of seeks. Skipped frames are decoded
+    but never converted. skip_frames ("noref" or "nokey") makes the decoder
+    itself discard non-reference frames or all frames but keyframes.
+
+    counters holds numbers of frames decoded and of decoded frames skipped
+    (by sampling, seeks or out of order timestamps), of seeks done by the
+    player, and the seconds the decoding thread slept waiting for the
+    player (decoder_sleep).
+    """
+
+    def __init__(self, video_file, prefetch=DEFAULT_PREFETCH, ff_opts=None,
+                 downsample=1, downsample_mode="block", sample_rate=None,
+                 skip_frames=None):
+        opts = dict(DEFAULT_FF_OPTS)
+        if ff_opts is not None:
+            opts.update(ff_opts)
+        lib_opts = {}
+        if skip_frames is not None:
+            if skip_frames not in ("noref", "nokey"):
+                raise ValueError("Unknown frame skipping mode {0}".format(
+                    skip_frames))
+            lib_opts["skip_frame"] = skip_frames
+        self.video_file = video_file
+        self.prefetch = max(1, prefetch)
+        if downsample_mode not in ("block", "decoder"):
+            raise ValueError("Unknown downsample mode {0}".format(
+                downsample_mode))
+        self.downsample = downsample
+        self.downsample_mode = downsample_mode
+        self.sample_rate = sample_rate
+        self.metadata = None
+        self.frame_shape = None
+        self.fps = None
+        self.stride = 1
+        self.position = None
+        self._skip_until = None
+        self._error = None
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.player = MediaPlayer(video_file, callback=self._player_callback,
+                                  thread_lib="SDL", ff_opts=opts,
+                                  lib_opts=lib_opts)
+
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._eof_generation = None
+        self._seek_to = None
+        self._seek_requested = threading.Event()
+        self._metadata_ready = threading.Event()
+        self._closed = threading.Event()
+
+        self._thread = threading.Thread(target=self._decode)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._eof_generation != self._generation:
+            generation, item = self._queue.get()
+            if generation != self._generation:
+                continue
+            if item is None:
+                self._eof_generation = generation
+                break
+            if isinstance(item, Exception):
+                raise item
+            if self._skip_until is not None:
+                if item[1] < self._skip_until:
+                    self.counters["frames_skipped"] += 1
+                    continue
+                self._skip_until = None
+            self.position = item[1]
+            return item
+        raise StopIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_metadata(self):
+        """
+        Returns player metadata, waiting for the first decoded frame.
+        """
+        self._metadata_ready.wait()
+        return self.metadata
+
+    def queue_depth(self):
+        """
+        Returns the number of decoded frames waiting to be read.
+        """
+        return self._queue.qsize()
+
+    def seek(self, t):
+        """
+        Seeks to absolute time t (in seconds). Iteration continues with frames
+        with timestamp >= t.
+        """
+        if self.position is not None and \
+           0 <= t - self.position <= self._read_through_distance():
+            self._skip_until = t
+            return
+        self._skip_until = None
+        with self._lock:
+            self._generation += 1
+            self._seek_to = t
+            self._seek_requested.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def close(self):
+        """
+        Stops decoding and closes the player.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._thread.join()
+        self.player.close_player()
+
+    def _read_through_distance(self):
+        if not self.fps:
+            return SEEK_READ_THROUGH
+        return max(SEEK_READ_THROUGH,
+                   (self.prefetch*self.stride + _STALE_FRAMES) / self.fps)
+
+    def _put(self, generation, item):
+        """
+        Puts an item in the queue, giving up when the item becomes stale.
+        """
+        while not self._closed.is_set() and generation == self._generation:
+            try:
+                self._queue.put((generation, item), timeout=_WAKEUP)
+                return
+            except queue.Full:
+                pass
+
+    def _player_callback(self, selector, value):
+        if selector == "read:error":
+            self._error = IOError("Cannot read video file {0}".format(
+                self.video_file))
+
+    def _init_stream(self, size, metadata):
+        width, height = size
+        self.frame_shape = downsampled_shape((height, width), self.downsample)
+        if self.downsample > 1 and self.downsample_mode == "decoder":
+            self.player.set_size(self.frame_shape[1], self.frame_shape[0])
+        num, den = metadata.get("frame_rate", (0, 0))
+        if num and den:
+            self.fps = float(num) / den
+        self.stride = frame_stride((num, den), self.sample_rate)
+
+    def _decode(self):
+        player = self.player
+        t0 = 0
+        stale_after = None
+        restart_at = None
+        decoded_size = None
+        eof = False
+        while not self._closed.is_set():
+            with self._lock:
+                generation = self._generation
+                seek_to = self._seek_to
+                self._seek_to = None
+                self._seek_requested.clear()
+            if seek_to is not None:
+                player.seek(seek_to, relative=False)
+                self.counters["seeks"] += 1
+                # After a backward seek, frames decoded before the seek
+                # are recognised by timestamps past the old position
+                stale_after = t0 if seek_to < t0 else None
+                t0 = seek_to
+                eof = False
+            elif eof:
+                self._seek_requested.wait(_WAKEUP)
+                continue
+
+            if self._error is not None:
+                self._metadata_ready.set()
+                self._put(generation, self._error)
+                eof = True
+                continue
+
+            frame, val = player.get_frame()
+            if val == 'eof':
+                eof = True
+                self._metadata_ready.set()
+                if restart_at is not None:
+                    self._put(generation, IOError(
+                        "Decoder scaling of {0} produced no frames".format(
+                            self.video_file)))
+                    continue
+                self._put(generation, None)
+                continue
+            if frame is None:
+                time.sleep(_DECODER_POLL)
+                self.counters["decoder_sleep"] += _DECODER_POLL
+                continue
+
+            img, t = frame
+            self.counters["frames_decoded"] += 1
+            if stale_after is not None:
+                if t > stale_after:
+                    self.counters["frames_skipped"] += 1
+                    continue
+                stale_after = None
+            if t < t0:
+                self.counters["frames_skipped"] += 1
+                continue
+            t0 = t
+            if self.metadata is None:
+                metadata = player.get_metadata()
+                self._init_stream(img.get_size(), metadata)
+                self.metadata = metadata
+                if self.downsample > 1 and self.downsample_mode == "decoder":
+                    restart_at = t
+                    decoded_size = img.get_size()
+                else:
+                    self._metadata_ready.set()
+            if restart_at is not None:
+                # Frames decoded before the scaler took effect are dropped;
+                # once it did, decoding starts again from the first frame.
+                # The scaler may round the requested size (e.g. to even
+                # heights), so frame_shape is taken from its output.
+                self.counters["frames_skipped"] += 1
+                if img.get_size() != decoded_size:
+                    width, height = img.get_size()
+                    self.frame_shape = (height, width)
+                    self._metadata_ready.set()
+                    player.seek(restart_at, relative=False)
+                    self.counters["seeks"] += 1
+                    stale_after = t
+                    t0 = restart_at
+                    restart_at = None
+                continue
+            if self.stride > 1 and int(round(t*self.fps)) % self.stride:
+                self.counters["frames_skipped"] += 1
+                continue
+            cframe = plane_view(img)
+            if cframe.shape != self.frame_shape:
+                if self.downsample_mode == "decoder":
+                    # Never mix frames of the decoder's scaler with block
+                    # averaged ones
+                    self.counters["frames_skipped"] += 1
+                    continue
+                cframe = block_mean(cframe, self.downsample)
+            self._put(generation, (cframe, t))
+        self._metadata_ready.set()
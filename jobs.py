@@ -0,0 +1,310 @@
+"""
+Background export jobs of the GUI.
+
+JobManager queues exports and runs at most `workers` of them at a time,
+each in its own process (this module run as a script), so that analysis
+never competes with the UI for the GIL. A job process reports progress
+records (see stats.ProgressMeter) and previews as JSON lines on stdout and
+stops cleanly when "cancel" (or end of input) arrives on stdin: the
+analysis is cancelled with AnalysisCancelled, which closes the decoder and
+writes out (and checkpoints) the rows computed so far. Kivy is never
+imported here.
+"""
+import argparse
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from frame_differences import AnalysisCancelled, calculate_frame_diffs_wcall
+from preview import PreviewChannel
+from roi_config import load_config, save_config
+
+DEFAULT_JOB_WORKERS = 1
+# Seconds a cancelled job may take to stop before it is terminated
+CANCEL_TIMEOUT = 10.0
+# Exit status of a cancelled job process
+_EXIT_CANCELLED = 2
+
+
+class Job(object):
+    """
+    State of an export job, updated by JobManager.
+
+    state is "queued", "running", "done", "failed" or "cancelled".
+    """
+
+    def __init__(self, job_id, video_file, output, config_file, params):
+        self.id = job_id
+        self.video_file = video_file
+        self.output = output
+        self.config_file = config_file
+        self.params = params
+        self.state = "queued"
+        self.progress = 0.0
+        self.record = None
+        self.error = ""
+        self.started = None
+        self.finished = None
+        self.process = None
+        self.cancel_requested = None
+        self._preview = None
+
+    @property
+    def active(self):
+        return self.state in ("queued", "running")
+
+    def eta(self):
+        """
+        Returns estimated seconds until the job ends, or None.
+        """
+        if self.state != "running":
+            return None
+        if self.record is not None:
+            return self.record["eta"]
+        if self.progress <= 0:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed * (1 - self.progress) / self.progress
+
+    def take_preview(self):
+        """
+        Returns the latest preview image (see preview_image), or None if
+        there is none since the last call.
+        """
+        preview, self._preview = self._preview, None
+        return preview
+
+
+class JobManager(object):
+    """
+    Queue of export jobs run in worker processes.
+
+    notify is called (from a reader thread) whenever the state, progress or
+    preview of a job changes.
+    """
+
+    def __init__(self, workers=DEFAULT_JOB_WORKERS, notify=None):
+        self.workers = max(1, workers)
+        self.notify = notify
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._directory = tempfile.mkdtemp(prefix="pixeltracking_jobs_")
+
+    def submit(self, video_file, masks, cut_ranges, output, geometries=None,
+               **params):
+        """
+        Queues an export of a video. masks are boolean arrays or
+        PackedMasks; with geometries (ROIGeometry of the masks), the job
+        rasterizes the masks itself. params are passed on to
+        calculate_frame_diffs_wcall and must be JSON serializable.
+
+        Returns the Job.
+        """
+        with self._lock:
+            job_id = len(self.jobs)
+            config_file = os.path.join(self._directory,
+                                       "{0}.npz".format(job_id))
+            # Only read once by the job process, so not compressed
+            save_config(config_file, masks, cut_ranges, compress=False,
+                        geometries=geometries)
+            job = Job(job_id, video_file, output, config_file, params)
+            self.jobs.append(job)
+            self._start_queued()
+        self._notify()
+        return job
+
+    def cancel(self, job):
+        """
+        Cancels a queued job, or asks a running job to stop.
+        """
+        with self._lock:
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.finished = time.time()
+            elif job.state == "running" and job.cancel_requested is None:
+                job.cancel_requested = time.time()
+                try:
+                    job.process.stdin.write("cancel\n")
+                    job.process.stdin.flush()
+                except (OSError, ValueError):
+                    pass
+        self._notify()
+
+    def shutdown(self, timeout=CANCEL_TIMEOUT):
+        """
+        Cancels all jobs and waits for their processes to stop.
+        """
+        for job in list(self.jobs):
+            self.cancel(job)
+        deadline = time.time() + timeout
+        for job in list(self.jobs):
+            if job.process is None:
+                continue
+            try:
+                job.process.wait(max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                job.process.terminate()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def check(self):
+        """
+        Terminates jobs which did not stop within CANCEL_TIMEOUT after
+        being cancelled. Meant to be called periodically.
+        """
+        now = time.time()
+        with self._lock:
+            for job in self.jobs:
+                if (job.state == "running" and job.cancel_requested
+                        and now - job.cancel_requested > CANCEL_TIMEOUT):
+                    job.process.terminate()
+
+    def _start_queued(self):
+        running = sum(job.state == "running" for job in self.jobs)
+        for job in self.jobs:
+            if running >= self.workers:
+                break
+            if job.state == "queued":
+                self._start(job)
+                running += 1
+
+    def _start(self, job):
+        job.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), job.config_file,
+             job.video_file, job.output, json.dumps(job.params)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True, bufsize=1)
+        job.state = "running"
+        job.started = time.time()
+        thread = threading.Thread(target=self._read, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+    def _read(self, job):
+        for line in job.process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            with self._lock:
+                if "progress" in message:
+                    job.progress = message["progress"]
+                if "record" in message:
+                    job.record = message["record"]
+                    job.progress = job.record["progress"]
+                if "preview" in message:
+                    job._preview = decode_preview(message)
+                if "error" in message:
+                    job.error = message["error"]
+            self._notify()
+        status = job.process.wait()
+        with self._lock:
+            if status == 0:
+                job.state = "done"
+                job.progress = 1.0
+            elif (status == _EXIT_CANCELLED
+                  or job.cancel_requested is not None and status < 0):
+                job.state = "cancelled"
+            else:
+                job.state = "failed"
+                job.error = job.error or "exit status {0}".format(status)
+            job.finished = time.time()
+            if os.path.isfile(job.config_file):
+                os.remove(job.config_file)
+            self._start_queued()
+        self._notify()
+
+    def _notify(self):
+        if self.notify is not None:
+            self.notify()
+
+
+def encode_preview(image):
+    """
+    Returns a JSON serializable message of a preview image (0 or 255).
+    """
+    return {"shape": list(image.shape),
+            "preview": base64.b64encode(
+                np.packbits(image > 0).tobytes()).decode("ascii")}
+
+
+def decode_preview(message):
+    shape = tuple(message["shape"])
+    bits = np.frombuffer(base64.b64decode(message["preview"]),
+                         dtype=np.uint8)
+    return (np.unpackbits(bits, count=shape[0]*shape[1]).reshape(shape)
+            * np.uint8(255))
+
+
+def run_job(config_file, video_file, output, params, stdin=None,
+            stdout=None):
+    """
+    Runs an export in a job process. Returns the exit status.
+    """
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    cancel = threading.Event()
+
+    def watch_input():
+        # End of input means that the manager is gone
+        for line in stdin:
+            if line.strip() == "cancel":
+                break
+        cancel.set()
+
+    def send(message):
+        stdout.write(json.dumps(message) + "\n")
+        stdout.flush()
+
+    channel = PreviewChannel()
+
+    def progress_callback(record):
+        send({"record": record})
+
+    def callback(progress, frame_diff):
+        channel(progress, frame_diff)
+        _, image = channel.take()
+        if image is not None:
+            send(encode_preview(image))
+
+    watcher = threading.Thread(target=watch_input)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        masks, cut_ranges = load_config(config_file, geometry=True)
+        calculate_frame_diffs_wcall(video_file, masks, cut_ranges,
+                                    callback=callback, output=output,
+                                    cancel=cancel,
+                                    progress_callback=progress_callback,
+                                    **params)
+    except AnalysisCancelled:
+        return _EXIT_CANCELLED
+    except Exception as e:
+        send({"error": "{0}: {1}".format(type(e).__name__, e)})
+        return 1
+    send({"progress": 1.0})
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Runs one export job (started by JobManager).")
+    parser.add_argument("config")
+    parser.add_argument("video")
+    parser.add_argument("output")
+    parser.add_argument("params", help="JSON keyword arguments of "
+                        "calculate_frame_diffs_wcall")
+    args = parser.parse_args(argv)
+    return run_job(args.config, args.video, args.output,
+                   json.loads(args.params))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
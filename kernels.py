@@ -0,0 +1,252 @@
+import time
+
+import numpy as np
+
+# Pixels of the frames of a FrameBlock (see default_block_frames). Blocks of
+# a few MB amortize per-frame Python overhead while keeping work buffers
+# small; 1080p frames are processed one by one.
+DEFAULT_BLOCK_PIXELS = 2**21
+MAX_BLOCK_FRAMES = 64
+# Kernel backends: "numba" compiles a fused kernel (see compiled_kernels),
+# "auto" selects it when Numba is installed and "numpy" otherwise
+BACKENDS = ("auto", "numpy", "numba")
+
+
+class DiffKernel(object):
+    """
+    Thresholded difference of two uint8 frames of given shape, computed
+    into work buffers which are allocated once and reused for every frame.
+    Frames may be strided views.
+
+    A pixel is changed when th < |cframe - oframe| < 256 - th. The upper
+    bound reproduces results of the former expression
+    (cframe - oframe > th) & (oframe - cframe > th), which relied on uint8
+    subtraction wrapping around. Here |cframe - oframe| is computed as
+    max - min, which never wraps.
+
+    The returned boolean array is overwritten by the next call.
+    """
+
+    def __init__(self, shape, pixel_diff_threshold):
+        self.pixel_diff_threshold = pixel_diff_threshold
+        self.absdiff = np.empty(shape, dtype=np.uint8)
+        self.scratch = np.empty(shape, dtype=np.uint8)
+        self.changed = np.empty(shape, dtype=bool)
+        self.in_range = np.empty(shape, dtype=bool)
+
+    def abs_diff(self, cframe, oframe):
+        """
+        Returns |cframe - oframe| as uint8 (in a reused buffer).
+        """
+        np.maximum(cframe, oframe, out=self.absdiff)
+        np.minimum(cframe, oframe, out=self.scratch)
+        return np.subtract(self.absdiff, self.scratch, out=self.absdiff)
+
+    def threshold(self, absdiff, pixel_diff_threshold=None):
+        """
+        Returns the changed pixels of an absolute difference (in a reused
+        buffer), by default for the threshold of the kernel.
+        """
+        th = pixel_diff_threshold
+        if th is None:
+            th = self.pixel_diff_threshold
+        np.greater(absdiff, th, out=self.changed)
+        # The upper bound rarely matters, checking is cheaper than applying
+        if th > 0 and absdiff.max() >= 256 - th:
+            np.less(absdiff, 256 - th, out=self.in_range)
+            np.logical_and(self.changed, self.in_range, out=self.changed)
+        return self.changed
+
+    def __call__(self, cframe, oframe):
+        return self.threshold(self.abs_diff(cframe, oframe))
+
+    def head(self, n):
+        """
+        Returns a kernel working in the first n entries of the buffers of
+        a kernel for blocks of frames.
+        """
+        kernel = DiffKernel.__new__(DiffKernel)
+        kernel.pixel_diff_threshold = self.pixel_diff_threshold
+        for name in ("absdiff", "scratch", "changed", "in_range"):
+            setattr(kernel, name, getattr(self, name)[:n])
+        return kernel
+
+
+class SingleThreshold(object):
+    """
+    Changed pixel fractions (see ROIEngine.fractions) of a frame pair for
+    one threshold. When stats (a PipelineStats) is set, the diff and
+    aggregate stages are timed.
+    """
+    stats = None
+
+    def __init__(self, shape, pixel_diff_threshold, engine):
+        self.kernel = DiffKernel(shape, pixel_diff_threshold)
+        self.engine = engine
+
+    def __call__(self, cframe, oframe):
+        if self.stats is None:
+            return self.engine.fractions(self.kernel(cframe, oframe))
+        start = time.perf_counter()
+        frame_diff = self.kernel(cframe, oframe)
+        start = self.stats.add("diff", start)
+        fractions = self.engine.fractions(frame_diff)
+        self.stats.add("aggregate", start)
+        return fractions
+
+    def frame_diff(self):
+        """
+        Returns the changed pixels of the last frame pair.
+        """
+        return self.kernel.changed
+
+
+class ThresholdSweep(object):
+    """
+    Changed pixel fractions of a frame pair for several thresholds, as
+    [Overall, ROI0, ...] for the first threshold followed by the same for
+    the other thresholds.
+
+    The absolute difference and its histograms, over the whole frame and
+    per ROI (see ROIEngine.histograms), are computed once per frame pair.
+    Counts for every threshold are sums over the histogram bins selected
+    by the same rule as in DiffKernel, so their cost hardly depends on the
+    number of thresholds.
+    """
+    stats = None
+
+    def __init__(self, shape, thresholds, engine):
+        self.thresholds = list(thresholds)
+        self.kernel = DiffKernel(shape, self.thresholds[0])
+        self.engine = engine
+        values = np.arange(256)
+        self.bins = np.stack([(values > th) & (values < 256 - th)
+                              for th in self.thresholds],
+                             axis=1).astype(np.int64)
+
+    def __call__(self, cframe, oframe):
+        if self.stats is not None:
+            start = time.perf_counter()
+        absdiff = self.kernel.abs_diff(cframe, oframe)
+        if self.stats is not None:
+            start = self.stats.add("diff", start)
+        overall = np.bincount(absdiff.ravel(), minlength=256).dot(self.bins)
+        rois = self.engine.histograms(absdiff).dot(self.bins)
+        counts = np.vstack([overall, rois])
+        if self.stats is not None:
+            self.stats.add("aggregate", start)
+        return list(counts.T.ravel() / float(absdiff.size))
+
+    def frame_diff(self):
+        """
+        Returns the changed pixels of the last frame pair for the first
+        threshold.
+        """
+        return self.kernel.threshold(self.kernel.absdiff)
+
+
+class FrameBlock(object):
+    """
+    Consecutive frames collected into a (K + 1, height, width) array, so
+    that differences and ROI fractions of K frame pairs are computed with
+    a few vectorized calls (see ROIEngine.block_counts) instead of Python
+    code running for every frame. The first frame of the block is the
+    reference frame of the first pair.
+    """
+    stats = None
+
+    def __init__(self, shape, pixel_diff_threshold, engine, block_frames):
+        shape = tuple(shape)
+        self.kernel = DiffKernel((block_frames,) + shape,
+                                 pixel_diff_threshold)
+        self.engine = engine
+        self.frames = np.empty((block_frames + 1,) + shape, dtype=np.uint8)
+        self.ranges = np.empty(block_frames, dtype=np.int64)
+        self.times = np.empty(block_frames, dtype=np.float64)
+        self.n = 0
+
+    def start(self, oframe):
+        """
+        Starts a block with a reference frame, dropping collected frames.
+        """
+        self.frames[0] = oframe
+        self.n = 0
+
+    def add(self, cframe, crange, t):
+        """
+        Adds a frame of range crange at time t. Returns True when the block
+        is full.
+        """
+        self.ranges[self.n] = crange
+        self.times[self.n] = t
+        self.n += 1
+        self.frames[self.n] = cframe
+        return self.n == len(self.times)
+
+    def flush(self):
+        """
+        Computes differences of the collected frames and starts the next
+        block from the last frame.
+
+        Returns tuple (rows, kernel) where rows is an array of
+        [Range, Time, Overall, ROI0, ...] rows and kernel holds the
+        absolute and thresholded differences of the rows.
+        """
+        n = self.n
+        kernel = self.kernel if n == len(self.times) else self.kernel.head(n)
+        if self.stats is not None:
+            start = time.perf_counter()
+        changed = kernel(self.frames[1:n+1], self.frames[:n])
+        if self.stats is not None:
+            start = self.stats.add("diff", start)
+        overall, rois = self.engine.block_counts(changed)
+        n_pixels = float(changed[0].size) if n else 1.0
+        rows = np.column_stack([self.ranges[:n], self.times[:n],
+                                overall / n_pixels, rois / n_pixels])
+        if n:
+            self.frames[0] = self.frames[n]
+        self.n = 0
+        if self.stats is not None:
+            self.stats.add("aggregate", start)
+        return rows, kernel
+
+
+def default_block_frames(shape):
+    """
+    Returns the number of frames of shape per FrameBlock, 1 for frames too
+    large to gain from blocks.
+    """
+    n_pixels = int(np.prod(shape))
+    return max(1, min(MAX_BLOCK_FRAMES, DEFAULT_BLOCK_PIXELS // n_pixels))
+
+
+def resolve_backend(backend="auto"):
+    """
+    Returns the kernel backend ("numpy" or "numba") used for a backend
+    name (see BACKENDS). "auto" resolves to "numba" when Numba is
+    installed and to "numpy" otherwise. Raises ImportError when "numba" is
+    requested but Numba is not installed.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown kernel backend {0!r}, expected one of "
+                         "{1}".format(backend, ", ".join(BACKENDS)))
+    if backend == "numpy":
+        return "numpy"
+    try:
+        import compiled_kernels  # noqa: F401
+    except ImportError:
+        if backend == "numba":
+            raise
+        return "numpy"
+    return "numba"
+
+
+def single_threshold(shape, pixel_diff_threshold, engine, backend="auto"):
+    """
+    Returns SingleThreshold, or its compiled equivalent for the "numba"
+    backend (see resolve_backend).
+    """
+    if resolve_backend(backend) == "numba":
+        from compiled_kernels import CompiledSingleThreshold
+        return CompiledSingleThreshold(shape, pixel_diff_threshold, engine)
+    return SingleThreshold(shape, pixel_diff_threshold, engine)
@@ -5,7 +5,8 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.popup import Popup
 from kivy.uix.dropdown import DropDown
-from kivy.graphics import Color, Ellipse, Line, Rectangle, Fbo
+from kivy.uix.label import Label
+from kivy.graphics import Color, Rectangle
 from kivy.graphics.texture import Texture
 from kivy.properties import ObjectProperty, BooleanProperty, StringProperty, NumericProperty
 from kivy.event import EventDispatcher
@@ -16,7 +17,6 @@ Config.set('input', 'mouse', 'mouse,disable_multitouch')
 
 from filebrowser import FileBrowser
 
-import threading
 import numpy as np
 import pandas as pd
 
@@ -24,7 +24,15 @@ import os
 
 import cutpoint_line
 
-from frame_differences import calculate_frame_diffs_wcall
+from checkpoint import DEFAULT_CHECKPOINT_INTERVAL
+from frame_cache import DEFAULT_CACHE_SIZE
+from jobs import DEFAULT_JOB_WORKERS, JobManager
+from preview import PREVIEW_SEC_CALLBACK
+from results import sink_class
+from roi_config import save_config
+from roi_geometry import ROIGeometry, Stroke
+from roi_masks import PackedMask
+from stats import format_progress
 
 roi_colors = [[ 0.10588235,  0.61960784,  0.46666667, 1],
               [ 0.85098039,  0.37254902,  0.00784314, 1],
@@ -33,6 +41,21 @@ roi_colors = [[ 0.10588235,  0.61960784,  0.46666667, 1],
               [ 0.4       ,  0.65098039,  0.11764706, 1],
               [ 0.90196078,  0.67058824,  0.00784314, 1]]
 
+def parse_thresholds(text):
+    """
+    Parses comma separated pixel difference thresholds. Returns a single
+    threshold, or a list of thresholds for a threshold sweep.
+    """
+    thresholds = []
+    for item in text.replace(";", ",").split(","):
+        if item.strip():
+            value = float(item)
+            thresholds.append(int(value) if value.is_integer() else value)
+    if not thresholds:
+        raise ValueError("No pixel difference threshold given")
+    return thresholds[0] if len(thresholds) == 1 else thresholds
+
+
 class LoadDialog(Popup):
     load = ObjectProperty(None)
 
@@ -46,22 +69,62 @@ class ConfirmDialog(Popup):
     text = StringProperty("")
 
 
+class JobRow(BoxLayout):
+    """
+    Name, state and progress record (frames, frame rate, realtime factor,
+    ETA and range) of an export job, with a cancel button.
+    """
+    job = ObjectProperty(None)
+    text = StringProperty("")
+    progress = NumericProperty(0)
+    active = BooleanProperty(True)
+
+    def update(self):
+        job = self.job
+        text = "{0}: {1}".format(os.path.basename(job.output), job.state)
+        if job.state == "running" and job.record is not None:
+            text += ", " + format_progress(job.record)
+        elif job.error:
+            text += " ({0})".format(job.error)
+        self.text = text
+        self.progress = job.progress
+        self.active = job.active
+
+    def cancel(self):
+        App.get_running_app().jobs.cancel(self.job)
+
+
 class VideoProgress(Popup):
+    """
+    Export jobs with their progress, and a preview of the latest frame
+    difference of the most recently started running job. Previews are made
+    by the job processes and shown in one reused texture.
+    """
 
-    def __init__(self, **kwargs):
+    def __init__(self, jobs, **kwargs):
         super(VideoProgress, self).__init__(**kwargs)
         self.ids.image_id.color = (1, 1, 1, 0)
-
-    @mainthread
-    def update_progress(self, progress_fraction, image_matrix):
-        self.ids.progressbar_id.value = progress_fraction
-        m = np.zeros(shape=image_matrix.shape, dtype=np.uint8)
-        m[image_matrix == 1] = 255
-        texture = Texture.create(size=(m.shape[1], m.shape[0]))
-        texture.blit_buffer(m.tostring(), colorfmt="luminance",
-                            bufferfmt="ubyte")
-        self.ids.image_id.texture = texture
-        self.ids.image_id.texture.flip_vertical()
+        self.jobs = jobs
+        self.rows = {}
+        self._texture = None
+
+    def update_progress(self):
+        for job in self.jobs.jobs:
+            row = self.rows.get(job.id)
+            if row is None:
+                row = self.rows[job.id] = JobRow(job=job)
+                self.ids.jobs_id.add_widget(row)
+            row.update()
+        running = [job for job in self.jobs.jobs if job.state == "running"]
+        image = running[-1].take_preview() if running else None
+        if image is None:
+            return
+        size = (image.shape[1], image.shape[0])
+        if self._texture is None or self._texture.size != size:
+            self._texture = Texture.create(size=size, colorfmt="luminance")
+            self.ids.image_id.texture = self._texture
+        self._texture.blit_buffer(image.data, colorfmt="luminance",
+                                  bufferfmt="ubyte")
         self.ids.image_id.color = (1, 1, 1, 1)
         self.ids.image_id.canvas.ask_update()
 
@@ -109,97 +172,149 @@ class ROIList(EventDispatcher):
         pass
 
 
+class ROILayer(object):
+    """
+    ROI drawn in the video widget: its geometry (ROIGeometry in video
+    pixels), the mask rasterized from it at video resolution, and the
+    texture showing the mask. Changed parts of the mask are uploaded to
+    the texture, so no FBO is drawn or read back.
+    """
+
+    def __init__(self, size):
+        width, height = size
+        self.geometry = ROIGeometry(size)
+        self.mask = np.zeros((height, width), dtype=bool)
+        self.packed = PackedMask.pack(self.mask)
+        self.texture = Texture.create(size=size, colorfmt="luminance_alpha")
+        self.show(slice(0, height), slice(0, width))
+        self.color = None
+        self.rect = None
+
+    def paint(self, stroke, start=0):
+        updated = stroke.paint(self.mask, start=start)
+        if updated is not None:
+            self.show(*updated)
+
+    def redraw(self):
+        self.mask = self.geometry.rasterize()
+        self.show(slice(0, self.mask.shape[0]), slice(0, self.mask.shape[1]))
+
+    def show(self, rows, columns):
+        part = self.mask[rows, columns]
+        if not part.size:
+            return
+        # Luminance and alpha are 255 inside the ROI, so the layer's Color
+        # tints the ROI and the rest stays transparent
+        pixels = np.repeat(part * np.uint8(255), 2, axis=1)
+        self.texture.blit_buffer(pixels.tobytes(),
+                                 pos=(columns.start, rows.start),
+                                 size=(part.shape[1], part.shape[0]),
+                                 colorfmt="luminance_alpha",
+                                 bufferfmt="ubyte")
+
+
 class VideoWidget(Video):
 
     cutpoint_panel = ObjectProperty(None)
     video_loaded = BooleanProperty(False)
     roi_marker_size = NumericProperty(40.0)
-
-    stop = threading.Event()
+    thresholds = StringProperty("10")
 
     def __init__(self, **kwargs):
         super(VideoWidget, self).__init__(**kwargs)
 
         self.roi_list = App.get_running_app().roi_list
-        self.roi_list.bind(on_roi_added=self.add_roi_fbo)
-        self.roi_list.bind(on_roi_selected=self.select_roi_fbo)
-        self.roi_list.bind(on_roi_removed=self.remove_roi_fbo)
-        self.fbo_list = []
+        self.roi_list.bind(on_roi_added=self.add_roi_layer)
+        self.roi_list.bind(on_roi_selected=self.select_roi_layer)
+        self.roi_list.bind(on_roi_removed=self.remove_roi_layer)
+        self.roi_layers = []
         self.roi_mark_history = []
+        # Bit-packed masks of the ROIs are made once after every edit
+        # (see extract_roi_masks)
+        self._edited_layers = set()
+        self._extract_trigger = Clock.create_trigger(self.extract_roi_masks)
 
-    def add_roi_fbo(self, obj, new_value):
+    def add_roi_layer(self, obj, new_value):
+        layer = ROILayer(self.texture.size)
         with self.canvas:
-            fbo = Fbo(size=self.texture.size)
-            color = Color(*roi_colors[new_value % len(roi_colors)])
-            rect = Rectangle(size=self.vid_size, pos=self.vid_pos,
-                             texture=fbo.texture)
+            layer.color = Color(*roi_colors[new_value % len(roi_colors)])
+            rect = layer.rect = Rectangle(size=self.vid_size,
+                                          pos=self.vid_pos,
+                                          texture=layer.texture)
             self.bind(vid_size=lambda s, *args: setattr(rect, 'size', self.vid_size),
                       vid_pos=lambda s, *args: setattr(rect, 'pos', self.vid_pos))
-            self.fbo_list.append((fbo, color, rect))
+        self.roi_layers.append(layer)
 
-    def select_roi_fbo(self, obj, index):
-        for fbo_t in self.fbo_list:
-            fbo_t[1].a = 0.5
-        self.fbo_list[index][1].a = 0.75
+    def select_roi_layer(self, obj, index):
+        for layer in self.roi_layers:
+            layer.color.a = 0.5
+        self.roi_layers[index].color.a = 0.75
 
-    def remove_roi_fbo(self, obj, index):
-        self.canvas.remove(self.fbo_list[index][0])
-        self.canvas.remove(self.fbo_list[index][1])
-        self.canvas.remove(self.fbo_list[index][2])
+    def remove_roi_layer(self, obj, index):
+        layer = self.roi_layers[index]
+        self.canvas.remove(layer.color)
+        self.canvas.remove(layer.rect)
         # Remove all history related to deleted ROI
-        fbo = self.fbo_list[index][0]
-        i = 0
-        while i != len(self.roi_mark_history):
-            if self.roi_mark_history[i][0] == fbo:
-                del self.roi_mark_history[i]
-            else:
-                i += 1
-        del self.fbo_list[index]
+        self.roi_mark_history = [mark for mark in self.roi_mark_history
+                                 if mark[0] is not layer]
+        self._edited_layers.discard(layer)
+        del self.roi_layers[index]
+
+    def to_video_coords(self, touch, size):
+        x = (touch.x - self.vid_pos[0])/self.vid_size[0]*size[0]
+        y = (touch.y - self.vid_pos[1])/self.vid_size[1]*size[1]
+        return x, y
 
     def on_touch_down(self, touch):
         if not self.collide_point(*touch.pos)\
            or self.roi_list.selected is None:
             return
 
-        color = (1, 1, 1)
-
-        fbo = self.fbo_list[self.roi_list.selected][0]
-        x = (touch.x - self.vid_pos[0])/self.vid_size[0]*fbo.size[0]
-        y = (touch.y - self.vid_pos[1])/self.vid_size[1]*fbo.size[1]
+        layer = self.roi_layers[self.roi_list.selected]
+        size = layer.geometry.size
+        x, y = self.to_video_coords(touch, size)
 
         # Ensure position within video frame
-        if x < 0 or y < 0 or x > fbo.size[0] or y > fbo.size[1]:
+        if x < 0 or y < 0 or x > size[0] or y > size[1]:
             return
 
-        d = self.roi_marker_size
-
-        with fbo:
-            c = Color(*color, mode='rgb')
-            e = Ellipse(pos=(x - d / 2, y - d / 2), size=(d, d))
-            l = Line(points=(x, y), width=d/2, joint='round')
-            touch.ud['line'] = l
-            self.roi_mark_history.append((fbo, c, e, l))
+        stroke = layer.geometry.add(Stroke([(x, y)], self.roi_marker_size))
+        layer.paint(stroke)
+        touch.ud['stroke'] = stroke
+        touch.ud['layer'] = layer
+        self.roi_mark_history.append((layer, stroke))
 
     def on_touch_move(self, touch):
-        if self.roi_list.selected is None or "line" not in touch.ud:
+        if "stroke" not in touch.ud:
             return
 
-        fbo = self.fbo_list[self.roi_list.selected][0]
-        x = (touch.x - self.vid_pos[0])/self.vid_size[0]*fbo.size[0]
-        y = (touch.y - self.vid_pos[1])/self.vid_size[1]*fbo.size[1]
-        touch.ud['line'].points += [x, y]
+        layer, stroke = touch.ud['layer'], touch.ud['stroke']
+        stroke.add_point(self.to_video_coords(touch, layer.geometry.size))
+        layer.paint(stroke, start=len(stroke.points) - 1)
+
+    def on_touch_up(self, touch):
+        if "layer" in touch.ud:
+            self.roi_edited(touch.ud['layer'])
 
     def undo_roi_mark(self):
         if len(self.roi_mark_history) == 0:
             return
-        fbo, c, e, l = self.roi_mark_history[-1]
-        fbo.remove(c)
-        fbo.remove(e)
-        fbo.remove(l)
-        del self.roi_mark_history[-1]
-        fbo.bind()
-        fbo.clear_buffer()
-        fbo.release()
+        layer, stroke = self.roi_mark_history.pop()
+        layer.geometry.remove(stroke)
+        layer.redraw()
+        self.roi_edited(layer)
+
+    def roi_edited(self, layer):
+        self._edited_layers.add(layer)
+        self._extract_trigger()
+
+    def extract_roi_masks(self, *args):
+        """
+        Packs the masks of edited ROIs.
+        """
+        for layer in self._edited_layers:
+            layer.packed = PackedMask.pack(layer.mask)
+        self._edited_layers.clear()
 
     def on_texture(self, obj, texture):
         if self.state == "play":
@@ -251,14 +366,16 @@ class VideoWidget(Video):
         self._popup = SaveDialog(save=save_action)
         self._popup.open()
 
-    def verify_save_location(self, path, filename):
+    def verify_save_location(self, path, filename, save_action=None):
         self._confirm = None
+        if save_action is None:
+            save_action = self.save_fd_rois
 
         def finalize_save():
             if self._confirm is not None:
                 self._confirm.dismiss()
             self._popup.dismiss()
-            self.save_fd_rois(filename)
+            save_action(filename)
 
         filename = os.path.join(path, filename)
         if os.path.isdir(filename):
@@ -271,30 +388,61 @@ class VideoWidget(Video):
 
         finalize_save()
 
-    def save_fd_rois(self, filename):
-        width, height = self.texture.size
-        masks = [np.frombuffer(fbo[0].pixels, dtype="ubyte").reshape(height, width, 4)[:, :, 0] > 0
-                 for fbo in self.fbo_list]
-
-        self._progress = VideoProgress()
-        self._progress.open()
-
-        threading.Thread(target=self.calc_save_fd,
-                         args=(self.source, masks,
-                               (self.cutpoint_panel.cutpoints,
-                                self.cutpoint_panel.selected_ranges),
-                               filename,
-                               self._progress.update_progress)).start()
-
-    def calc_save_fd(self, source, masks, cutpoints, filename, callback):
-        diffs = calculate_frame_diffs_wcall(source, masks, cutpoints,
-                                            callback=callback)
-        self.close_progressbar()
-        diffs.to_csv(filename, index=False)
+    def get_roi_masks(self, display=False):
+        """
+        Returns PackedMasks of the ROIs at video resolution, or with
+        display at the size of the video on screen (computed once per
+        size and edit, see PackedMask.resized).
+        """
+        if self._edited_layers:
+            self._extract_trigger.cancel()
+            self.extract_roi_masks()
+        masks = [layer.packed for layer in self.roi_layers]
+        if not display:
+            return masks
+        shape = (int(self.vid_size[1]), int(self.vid_size[0]))
+        return [mask.resized(shape) for mask in masks]
+
+    def get_roi_geometries(self):
+        return [layer.geometry for layer in self.roi_layers]
+
+    def save_config_rois(self, filename):
+        save_config(filename, self.get_roi_masks(),
+                    (self.cutpoint_panel.cutpoints,
+                     self.cutpoint_panel.selected_ranges),
+                    geometries=self.get_roi_geometries())
 
-    @mainthread
-    def close_progressbar(self):
-        self._progress.dismiss()
+    def save_fd_rois(self, filename):
+        try:
+            pixel_diff_threshold = parse_thresholds(self.thresholds)
+        except ValueError as e:
+            Popup(title="Invalid thresholds", content=Label(text=str(e)),
+                  size_hint=(None, None), size=(400, 200)).open()
+            return
+        masks = self.get_roi_masks()
+        app = App.get_running_app()
+        # An export interrupted by a crash continues when it is repeated
+        checkpoint_interval = None
+        if sink_class(filename).resumable:
+            checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+        # With the diff cache enabled, exports of the same video with other
+        # ROIs reuse the differences
+        diff_cache_dir = None
+        if app.config.getboolean("export", "diff_cache"):
+            diff_cache_dir = os.path.join(app.user_data_dir, "diff_cache")
+        cache_size = int(app.config.getfloat("export", "diff_cache_size")
+                         * 2**30)
+        app.jobs.submit(self.source, masks,
+                        (self.cutpoint_panel.cutpoints,
+                         self.cutpoint_panel.selected_ranges),
+                        filename, geometries=self.get_roi_geometries(),
+                        pixel_diff_threshold=pixel_diff_threshold,
+                        sec_callback=PREVIEW_SEC_CALLBACK,
+                        checkpoint_interval=checkpoint_interval,
+                        resume=True,
+                        diff_cache_dir=diff_cache_dir,
+                        cache_size=cache_size)
+        app.show_exports()
 
 
 class ROISelector(BoxLayout):
@@ -343,10 +491,34 @@ class PixelTrackingApp(App):
     def __init__(self, **kwargs):
         super(PixelTrackingApp, self).__init__(**kwargs)
         self.roi_list = ROIList()
+        self.jobs = None
+        self.exports = None
+
+    def build_config(self, config):
+        config.setdefaults("export", {
+            "workers": DEFAULT_JOB_WORKERS,
+            "diff_cache": 0,
+            "diff_cache_size": DEFAULT_CACHE_SIZE / 2**30})
+
+    def build(self):
+        # Exports run in worker processes, see jobs.JobManager
+        self.jobs = JobManager(self.config.getint("export", "workers"),
+                               notify=self.update_exports)
+        Clock.schedule_interval(lambda dt: self.jobs.check(), 1)
+
+    def show_exports(self):
+        if self.exports is None:
+            self.exports = VideoProgress(self.jobs)
+        self.exports.update_progress()
+        self.exports.open()
+
+    @mainthread
+    def update_exports(self):
+        if self.exports is not None:
+            self.exports.update_progress()
 
     def on_stop(self):
-        video = self.root.ids.video_id
-        video.stop.set()
+        self.jobs.shutdown()
         os._exit(0)
 
 
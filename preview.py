@@ -0,0 +1,79 @@
+import threading
+import time
+
+import numpy as np
+
+# Longer side of preview images, in pixels
+PREVIEW_MAX_SIZE = 320
+# Minimal wall-clock time between previews, in seconds
+PREVIEW_INTERVAL = 0.2
+# Video time (in seconds) between analysis callbacks feeding a
+# PreviewChannel; most calls are dropped by the wall-clock limit
+PREVIEW_SEC_CALLBACK = 0.5
+
+
+def preview_image(frame_diff, max_size=PREVIEW_MAX_SIZE):
+    """
+    Returns a uint8 image (0 or 255) of a boolean (height, width) difference
+    frame, reduced by an integer factor to at most max_size pixels per side.
+    A preview pixel is set when any pixel of its block changed, so isolated
+    changes stay visible. Rows are in bottom-to-top order, as textures
+    expect.
+    """
+    height, width = frame_diff.shape
+    factor = max(1, -(-max(height, width) // max_size))
+    if factor > 1:
+        h, w = height // factor, width // factor
+        frame_diff = frame_diff[:h*factor, :w*factor].reshape(
+            h, factor, w, factor).any(axis=(1, 3))
+    return frame_diff[::-1] * np.uint8(255)
+
+
+class PreviewChannel(object):
+    """
+    Passes previews of a running analysis from the worker thread to the UI.
+
+    The channel is used as the analysis callback (progress, frame_diff).
+    The preview is made in the calling (worker) thread, at most once per
+    interval seconds of wall-clock time; other calls only record the
+    progress. Only the latest preview is kept: a preview which the UI has
+    not taken yet is replaced. notify is called (in the worker thread) when
+    a preview becomes available and the previous one was taken, so at most
+    one notification is pending at a time.
+    """
+
+    def __init__(self, notify=None, interval=PREVIEW_INTERVAL,
+                 max_size=PREVIEW_MAX_SIZE):
+        self.notify = notify
+        self.interval = interval
+        self.max_size = max_size
+        self.progress = 0
+        self._lock = threading.Lock()
+        self._image = None
+        self._pending = False
+        self._last = None
+
+    def __call__(self, progress, frame_diff):
+        self.progress = progress
+        now = time.monotonic()
+        if self._last is not None and now - self._last < self.interval:
+            return
+        self._last = now
+        image = preview_image(frame_diff, self.max_size)
+        with self._lock:
+            self._image = image
+            notify = not self._pending
+            self._pending = True
+        if notify and self.notify is not None:
+            self.notify()
+
+    def take(self):
+        """
+        Returns (progress, image) with the latest preview image, or None if
+        there is no new preview since the last call.
+        """
+        with self._lock:
+            image = self._image
+            self._image = None
+            self._pending = False
+        return self.progress, image
@@ -0,0 +1,65 @@
+import numpy as np
+
+
+def downsampled_shape(shape, factor):
+    """
+    Returns (height, width) of a frame of given shape reduced by factor.
+    Rows and columns not filling a whole block are dropped.
+    """
+    return shape[0] // factor, shape[1] // factor
+
+
+def _block_sums(array, factor, max_value):
+    """
+    Sums factor x factor blocks of a 2D array. Accumulating strided views
+    is much faster than summing over axes of a reshaped array.
+    """
+    h, w = downsampled_shape(array.shape, factor)
+    array = array[:h*factor, :w*factor]
+    dtype = np.uint16 if factor*factor*(max_value + 1) <= 2**16 \
+        else np.uint32
+    sums = np.zeros((h, w), dtype=dtype)
+    for i in range(factor):
+        for j in range(factor):
+            sums += array[i::factor, j::factor]
+    return sums
+
+
+def block_mean(frame, factor):
+    """
+    Reduces a 2D uint8 frame by averaging factor x factor pixel blocks,
+    rounding to the nearest integer.
+    """
+    if factor == 1:
+        return frame
+    n = factor*factor
+    sums = _block_sums(frame, factor, 255)
+    sums += n // 2
+    sums //= n
+    return sums.astype(np.uint8)
+
+
+def downsample_mask(mask, factor):
+    """
+    Reduces a 2D boolean mask by factor; a block belongs to the mask when
+    at least half of its pixels do.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if factor == 1:
+        return mask
+    counts = _block_sums(mask, factor, 1)
+    return 2*counts >= factor*factor
+
+
+def resize_mask(mask, shape):
+    """
+    Samples a 2D boolean mask at another (height, width): a pixel belongs
+    to the mask when the mask pixel under its centre does.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    shape = tuple(shape)
+    if shape == mask.shape:
+        return mask
+    rows = ((np.arange(shape[0]) + 0.5) * mask.shape[0] / shape[0])
+    columns = ((np.arange(shape[1]) + 0.5) * mask.shape[1] / shape[1])
+    return mask[rows.astype(np.intp)[:, None], columns.astype(np.intp)]
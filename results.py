@@ -0,0 +1,488 @@
+import json
+import os
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_BLOCK_SIZE = 4096
+DEFAULT_HISTOGRAM_BINS = 32
+
+
+class ResultBuffer(object):
+    """
+    Accumulates result rows in a preallocated float64 block. Full blocks
+    are handed over to a sink, so memory use does not grow with the number
+    of rows. When stats (a PipelineStats) is set, writing to the sink is
+    timed as the output stage.
+    """
+    stats = None
+
+    def __init__(self, columns, sink, block_size=DEFAULT_BLOCK_SIZE):
+        self.columns = list(columns)
+        self.sink = sink
+        self.block = np.empty((block_size, len(self.columns)),
+                              dtype=np.float64)
+        self.n = 0
+        self.rows = 0
+
+    def append(self, row):
+        self.block[self.n] = row
+        self.n += 1
+        self.rows += 1
+        if self.n == len(self.block):
+            self.flush()
+
+    def extend(self, rows):
+        """
+        Appends a 2D array (or list) of rows.
+        """
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1,
+                                                          len(self.columns))
+        i = 0
+        while i < len(rows):
+            k = min(len(rows) - i, len(self.block) - self.n)
+            self.block[self.n:self.n+k] = rows[i:i+k]
+            self.n += k
+            self.rows += k
+            i += k
+            if self.n == len(self.block):
+                self.flush()
+
+    def flush(self):
+        if self.n > 0:
+            start = time.perf_counter()
+            self.sink.write(self.block[:self.n])
+            self.n = 0
+            if self.stats is not None:
+                self.stats.add("output", start)
+
+    def close(self):
+        self.flush()
+        start = time.perf_counter()
+        self.sink.close()
+        if self.stats is not None:
+            self.stats.add("output", start)
+
+
+def block_frame(block, columns):
+    """
+    Converts a block of rows into a DataFrame with integer Range column.
+    """
+    df = pd.DataFrame(block, columns=columns)
+    return df.astype({"Range": np.int64})
+
+
+class ArraySink(object):
+    """
+    Keeps written blocks in memory.
+    """
+    coverage_row = True
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.blocks = []
+
+    def write(self, block):
+        self.blocks.append(block.copy())
+
+    def close(self):
+        pass
+
+    abort = close
+
+    def array(self):
+        if not self.blocks:
+            return np.empty((0, len(self.columns)), dtype=np.float64)
+        return np.concatenate(self.blocks)
+
+    def data_frame(self):
+        return block_frame(self.array(), self.columns)
+
+
+class CSVSink(object):
+    """
+    Appends written blocks to a CSV file.
+
+    Metadata is stored as JSON in <filename>.json, ROI coverage is kept in
+    the first row with Range equal to -1.
+    """
+    coverage_row = True
+    resumable = True
+
+    def __init__(self, filename, columns, metadata=None, resume=None):
+        self.columns = list(columns)
+        if resume is None:
+            if metadata is not None:
+                with open(filename + ".json", "w") as f:
+                    json.dump(dict(metadata, columns=self.columns), f)
+            self.file = open(filename, "w", newline="")
+            pd.DataFrame(columns=self.columns).to_csv(self.file, index=False)
+        else:
+            self.file = open(filename, "r+", newline="")
+            self.file.seek(resume["offset"])
+            self.file.truncate()
+
+    def write(self, block):
+        block_frame(block, self.columns).to_csv(self.file, header=False,
+                                                index=False)
+        self.file.flush()
+
+    def checkpoint(self):
+        """
+        Makes written data durable and returns state for resuming.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {"offset": self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+    abort = close
+
+
+def _zip_member(name):
+    """
+    Returns ZipInfo of an .npy archive member with a fixed date, so that
+    identical results give identical files.
+    """
+    info = zipfile.ZipInfo(name + ".npy", date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+class NPZSink(object):
+    """
+    Writes results to a .npz archive with one array per column and
+    metadata as JSON in the "__metadata__" array.
+
+    Blocks are spooled to <filename>.spool and transposed into columns on
+    close.
+    """
+    coverage_row = False
+    resumable = True
+
+    def __init__(self, filename, columns, metadata=None, resume=None):
+        self.filename = filename
+        self.columns = list(columns)
+        self.metadata = dict(metadata or {}, columns=self.columns)
+        self.spool_name = filename + ".spool"
+        self.keep_spool = resume is not None
+        if resume is None:
+            self.rows = 0
+            self.spool = open(self.spool_name, "w+b")
+        else:
+            self.rows = resume["rows"]
+            self.spool = open(self.spool_name, "r+b")
+            self.spool.truncate(self.rows*len(self.columns)*8)
+            self.spool.seek(0, os.SEEK_END)
+
+    def write(self, block):
+        self.spool.write(np.ascontiguousarray(block).tobytes())
+        self.rows += len(block)
+
+    def checkpoint(self):
+        """
+        Makes written data durable and returns state for resuming.
+        """
+        self.spool.flush()
+        os.fsync(self.spool.fileno())
+        self.keep_spool = True
+        return {"rows": self.rows}
+
+    def abort(self):
+        """
+        Closes the sink without writing the archive. The spool is kept if
+        it is needed for resuming.
+        """
+        self.spool.close()
+        if not self.keep_spool:
+            os.remove(self.spool_name)
+
+    def close(self):
+        self.spool.flush()
+        try:
+            if self.rows > 0:
+                data = np.memmap(self.spool_name, dtype=np.float64, mode="r",
+                                 shape=(self.rows, len(self.columns)))
+            else:
+                data = np.empty((0, len(self.columns)), dtype=np.float64)
+            with zipfile.ZipFile(self.filename, "w") as zf:
+                for j, name in enumerate(self.columns):
+                    column = data[:, j]
+                    if name == "Range":
+                        column = column.astype(np.int64)
+                    with zf.open(_zip_member(name), "w",
+                                 force_zip64=True) as f:
+                        np.lib.format.write_array(
+                            f, np.ascontiguousarray(column))
+                with zf.open(_zip_member("__metadata__"), "w") as f:
+                    np.lib.format.write_array(
+                        f, np.array(json.dumps(self.metadata)))
+            del data
+        finally:
+            self.spool.close()
+            os.remove(self.spool_name)
+
+
+class ParquetSink(object):
+    """
+    Writes results to a Parquet file (requires pyarrow). Metadata is stored
+    as JSON under the "pixel_tracking" key of the schema metadata.
+    Writing cannot be resumed.
+    """
+    coverage_row = False
+    resumable = False
+
+    def __init__(self, filename, columns, metadata=None):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.columns = list(columns)
+        fields = [pyarrow.field(c, pyarrow.int64() if c == "Range"
+                                else pyarrow.float64())
+                  for c in self.columns]
+        metadata = dict(metadata or {}, columns=self.columns)
+        self.schema = pyarrow.schema(fields, metadata={
+            "pixel_tracking": json.dumps(metadata)})
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+    def write(self, block):
+        arrays = [self.pa.array(block[:, j].astype(np.int64) if c == "Range"
+                                else block[:, j])
+                  for j, c in enumerate(self.columns)]
+        self.writer.write_table(self.pa.Table.from_arrays(
+            arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+    abort = close
+
+
+class HDF5Sink(object):
+    """
+    Writes results to an HDF5 file (requires h5py) with one resizable
+    dataset per column. Metadata is stored as JSON in the "metadata"
+    attribute of the root group.
+    """
+    coverage_row = False
+    resumable = True
+
+    def __init__(self, filename, columns, metadata=None, resume=None):
+        import h5py
+        self.columns = list(columns)
+        if resume is not None:
+            self.file = h5py.File(filename, "a")
+            self.rows = resume["rows"]
+            for c in self.columns:
+                self.file[c].resize((self.rows,))
+            return
+        self.file = h5py.File(filename, "w")
+        metadata = dict(metadata or {}, columns=self.columns)
+        self.file.attrs["metadata"] = json.dumps(metadata)
+        self.rows = 0
+        for c in self.columns:
+            self.file.create_dataset(
+                c, shape=(0,), maxshape=(None,), chunks=(DEFAULT_BLOCK_SIZE,),
+                dtype=np.int64 if c == "Range" else np.float64)
+
+    def write(self, block):
+        n = self.rows + len(block)
+        for j, c in enumerate(self.columns):
+            dataset = self.file[c]
+            dataset.resize((n,))
+            dataset[self.rows:n] = block[:, j]
+        self.rows = n
+        self.file.flush()
+
+    def checkpoint(self):
+        """
+        Makes written data durable and returns state for resuming.
+        """
+        self.file.flush()
+        return {"rows": self.rows}
+
+    def close(self):
+        self.file.close()
+
+    abort = close
+
+
+def histogram_record(n_rois, bins, max_count):
+    """
+    Returns the record type of a row of per-ROI histograms. Counts are
+    stored in the smallest unsigned type holding max_count.
+    """
+    dtype = np.uint16 if max_count < 2**16 else np.uint32
+    return np.dtype([("Range", np.int64), ("Time", np.float64),
+                     ("histograms", dtype, (n_rois, bins))])
+
+
+class HistogramArray(object):
+    """
+    Keeps rows of per-ROI histograms (records of histogram_record type) in
+    memory.
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.bins = record["histograms"].shape[-1]
+        self.blocks = []
+
+    def append(self, crange, t, histograms):
+        row = np.empty(1, dtype=self.record)
+        row["Range"] = crange
+        row["Time"] = t
+        row["histograms"] = histograms
+        self.write(row)
+
+    def write(self, rows):
+        self.blocks.append(rows)
+
+    def array(self):
+        if not self.blocks:
+            return np.empty(0, dtype=self.record)
+        return np.concatenate(self.blocks)
+
+
+class HistogramSink(HistogramArray):
+    """
+    Writes rows of per-ROI histograms of absolute frame differences to
+    a .npz archive with arrays "Range", "Time", "histograms" (rows x ROIs x
+    bins) and metadata as JSON in "__metadata__".
+
+    Rows are spooled to <filename>.spool and split into arrays on close.
+    """
+
+    def __init__(self, filename, record, metadata=None, resume=None):
+        super(HistogramSink, self).__init__(record)
+        self.filename = filename
+        self.metadata = dict(metadata or {})
+        self.spool_name = filename + ".spool"
+        self.keep_spool = resume is not None
+        if resume is None:
+            self.rows = 0
+            self.spool = open(self.spool_name, "w+b")
+        else:
+            self.rows = resume["rows"]
+            self.spool = open(self.spool_name, "r+b")
+            self.spool.truncate(self.rows*record.itemsize)
+            self.spool.seek(0, os.SEEK_END)
+
+    def write(self, rows):
+        self.spool.write(rows.tobytes())
+        self.rows += len(rows)
+
+    def checkpoint(self):
+        """
+        Makes written data durable and returns state for resuming.
+        """
+        self.spool.flush()
+        os.fsync(self.spool.fileno())
+        self.keep_spool = True
+        return {"rows": self.rows}
+
+    def abort(self):
+        """
+        Closes the sink without writing the archive. The spool is kept if
+        it is needed for resuming.
+        """
+        self.spool.close()
+        if not self.keep_spool:
+            os.remove(self.spool_name)
+
+    def close(self):
+        self.spool.flush()
+        try:
+            if self.rows > 0:
+                data = np.memmap(self.spool_name, dtype=self.record,
+                                 mode="r", shape=(self.rows,))
+            else:
+                data = np.empty(0, dtype=self.record)
+            with zipfile.ZipFile(self.filename, "w") as zf:
+                for name in self.record.names:
+                    with zf.open(_zip_member(name), "w",
+                                 force_zip64=True) as f:
+                        np.lib.format.write_array(
+                            f, np.ascontiguousarray(data[name]))
+                with zf.open(_zip_member("__metadata__"), "w") as f:
+                    np.lib.format.write_array(
+                        f, np.array(json.dumps(self.metadata)))
+            del data
+        finally:
+            self.spool.close()
+            os.remove(self.spool_name)
+
+
+def load_histograms(filename):
+    """
+    Loads histograms written by HistogramSink.
+
+    Returns tuple (ranges, times, histograms, metadata).
+    """
+    with np.load(filename) as data:
+        return (data["Range"], data["Time"], data["histograms"],
+                json.loads(str(data["__metadata__"])))
+
+
+SINKS = {".csv": CSVSink,
+         ".npz": NPZSink,
+         ".parquet": ParquetSink,
+         ".h5": HDF5Sink,
+         ".hdf5": HDF5Sink}
+
+
+def sink_class(filename):
+    """
+    Returns the sink class for the output format given by file extension.
+    Unknown extensions are written as CSV.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return SINKS.get(ext, CSVSink)
+
+
+def open_sink(filename, columns, metadata=None, resume=None):
+    """
+    Opens a sink for the output format given by file extension.
+
+    resume -- state returned by checkpoint() of an interrupted sink
+    """
+    cls = sink_class(filename)
+    if resume is not None:
+        return cls(filename, columns, metadata, resume=resume)
+    return cls(filename, columns, metadata)
+
+
+def load_results(filename):
+    """
+    Loads results written by any sink.
+
+    Returns tuple (DataFrame, metadata). For CSV files the coverage row is
+    part of the DataFrame and metadata is empty if there is no metadata
+    file.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".npz":
+        with np.load(filename) as data:
+            metadata = json.loads(str(data["__metadata__"]))
+            df = pd.DataFrame({c: data[c] for c in metadata["columns"]})
+    elif ext == ".parquet":
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(filename)
+        metadata = json.loads(table.schema.metadata[b"pixel_tracking"])
+        df = table.to_pandas()
+    elif ext in (".h5", ".hdf5"):
+        import h5py
+        with h5py.File(filename, "r") as f:
+            metadata = json.loads(f.attrs["metadata"])
+            df = pd.DataFrame({c: f[c][:] for c in metadata["columns"]})
+    else:
+        metadata = {}
+        if os.path.isfile(filename + ".json"):
+            with open(filename + ".json") as f:
+                metadata = json.load(f)
+        df = pd.read_csv(filename)
+    return df, metadata
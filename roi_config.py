@@ -0,0 +1,58 @@
+import json
+
+import numpy as np
+
+from roi_geometry import ROIGeometry
+from roi_masks import pack_mask
+
+
+def save_config(filename, masks, cut_ranges, compress=True,
+                geometries=None):
+    """
+    Saves ROI masks and cutpoints to a .npz file, compressed unless
+    compress is False.
+
+    Arguments:
+    masks -- list of boolean ROI masks or PackedMasks (all of the video
+             frame size)
+    cut_ranges -- tuple (cutpoints, selected_ranges)
+    geometries -- list of ROIGeometry of the masks, saved along with them
+                  so that masks can be rasterized again at any resolution
+    """
+    cutpoints, selected_ranges = cut_ranges
+    shape = masks[0].shape if masks else (0, 0)
+    packed = np.array([pack_mask(m) for m in masks], dtype=np.uint8)
+    arrays = {}
+    if geometries is not None:
+        arrays["geometry"] = np.array(json.dumps(
+            [g.to_dict() for g in geometries]))
+    savez = np.savez_compressed if compress else np.savez
+    with open(filename, "wb") as f:
+        savez(f, masks=packed.reshape(len(masks), -1),
+              shape=np.array(shape, dtype=np.int64),
+              cutpoints=np.array(cutpoints, dtype=np.float64),
+              selected_ranges=np.array(selected_ranges, dtype=bool),
+              **arrays)
+
+
+def load_config(filename, geometry=False):
+    """
+    Loads ROI masks and cutpoints saved with save_config. With geometry,
+    ROIs are returned as ROIGeometry when the config has their geometry
+    (calculate_frame_diffs_wcall rasterizes them at the analysed
+    resolution).
+
+    Returns tuple (masks, cut_ranges).
+    """
+    with np.load(filename) as data:
+        if geometry and "geometry" in data:
+            masks = [ROIGeometry.from_dict(g)
+                     for g in json.loads(str(data["geometry"]))]
+        else:
+            shape = tuple(int(s) for s in data["shape"])
+            size = shape[0]*shape[1]
+            masks = [np.unpackbits(m, count=size).astype(bool).reshape(shape)
+                     for m in data["masks"]]
+        cut_ranges = ([float(c) for c in data["cutpoints"]],
+                      [bool(s) for s in data["selected_ranges"]])
+    return masks, cut_ranges
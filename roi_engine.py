@@ -0,0 +1,247 @@
+import numpy as np
+
+# Below this fraction of ROI pixels within the ROI bounding box, flat index
+# arrays are cheaper to gather than scanning the bounding-box crop.
+SPARSE_DENSITY = 0.1
+# Up to this many ROI labels, changed pixels are counted label by label in
+# reusable buffers, which is faster than gathering their labels for
+# bincount and allocates nothing.
+PER_LABEL_MAX = 8
+# Up to this many ROIs, memberships of a pixel are coded as bits of an int64
+MAX_BIT_CODED_ROIS = 62
+
+
+def membership_labels(masks):
+    """
+    Returns (membership, labels) of boolean masks of equal shape: labels
+    numbers every pixel by its combination of ROI memberships, in
+    lexicographic order of the combinations, and row k of membership
+    (n_labels, n_rois) is the combination of label k.
+
+    Memberships are coded as bits of an integer per pixel (the first ROI
+    being the most significant), so labels come from a one-dimensional
+    unique, which is much faster than unique rows of a pixels x ROIs
+    matrix.
+    """
+    n = len(masks)
+    if n > MAX_BIT_CODED_ROIS:
+        stacked = np.stack([m.ravel() for m in masks], axis=1)
+        membership, labels = np.unique(stacked, axis=0, return_inverse=True)
+        return membership.astype(np.int64), labels.ravel().astype(np.intp)
+    codes = np.zeros(masks[0].size, dtype=np.int64)
+    for i, m in enumerate(masks):
+        codes |= m.ravel().astype(np.int64) << (n - 1 - i)
+    unique, labels = np.unique(codes, return_inverse=True)
+    shifts = np.arange(n - 1, -1, -1, dtype=np.int64)
+    membership = (unique[:, None] >> shifts) & 1
+    return membership, labels.ravel().astype(np.intp)
+
+
+class ROIEngine(object):
+    """
+    Precomputed ROI statistics for binary difference frames.
+
+    All masks are packed into a single label image: every pixel gets the
+    label of its combination of ROI memberships (overlapping ROIs are
+    allowed). A difference frame is then reduced with one bincount over the
+    labels of changed pixels, and per-ROI counts are obtained by multiplying
+    label counts with the label membership matrix.
+
+    Only pixels belonging to some ROI are visited. Depending on how densely
+    the ROIs fill their common bounding box, the labels are kept either as
+    a bounding-box crop ("bbox") or as flat pixel indices ("sparse").
+
+    Work buffers are reused between frames, so an engine must not be used
+    by several threads at once.
+    """
+
+    def __init__(self, masks, sparse_density=SPARSE_DENSITY):
+        masks = [np.asarray(m, dtype=bool) for m in masks]
+        self.n_rois = len(masks)
+        self.shape = masks[0].shape if masks else None
+        self.n_pixels = masks[0].size if masks else 0
+        self.representation = None
+        self.membership = np.zeros((1, 0), dtype=np.int64)
+        if self.n_rois == 0:
+            return
+
+        membership, labels = membership_labels(masks)
+        self.membership = membership
+        self._roi_pixels = (np.bincount(labels, minlength=len(membership))
+                            .dot(self.membership))
+        self._coverage = self._roi_pixels / float(self.n_pixels)
+
+        inside = self.membership.any(axis=1)[labels]
+        n_inside = np.count_nonzero(inside)
+        if n_inside == 0:
+            self.representation = "empty"
+            return
+
+        inside_2d = inside.reshape(self.shape)
+        rows = np.flatnonzero(inside_2d.any(axis=1))
+        cols = np.flatnonzero(inside_2d.any(axis=0))
+        self.bbox = (slice(rows[0], rows[-1] + 1),
+                     slice(cols[0], cols[-1] + 1))
+        bbox_area = (rows[-1] - rows[0] + 1) * (cols[-1] - cols[0] + 1)
+
+        if n_inside < sparse_density * bbox_area:
+            self.representation = "sparse"
+            self.indices = np.flatnonzero(inside)
+            self.labels = labels[self.indices]
+            self._gathered = np.empty(len(self.indices), dtype=bool)
+            self._gathered_values = np.empty(len(self.indices),
+                                             dtype=np.uint8)
+        else:
+            self.representation = "bbox"
+            self.labels = np.ascontiguousarray(
+                labels.reshape(self.shape)[self.bbox])
+
+        # Histogram bin of value 0 for every pixel, see histograms()
+        self._bin_offsets = self.labels.astype(np.intp) * 256
+        self._bins = np.empty(self.labels.shape, dtype=np.intp)
+
+        # Labels of pixels outside all ROIs need not be counted
+        self._counted = np.flatnonzero(self.membership.any(axis=1))
+        self._small_labels = None
+        if len(self._counted) <= PER_LABEL_MAX:
+            self._small_labels = self.labels.astype(np.uint8)
+            self._work = np.empty(self.labels.shape, dtype=bool)
+            # Buffer of block_counts, for the last block length
+            self._block_work = {}
+
+    def pixel_labels(self, shape=None):
+        """
+        Returns a (height, width) int32 array with the label (row of
+        self.membership) of every pixel. Pixels which are never counted get
+        label len(self.membership).
+
+        Arguments:
+        shape -- frame shape, used when the engine has no ROIs
+        """
+        shape = self.shape if self.shape is not None else shape
+        n_labels = len(self.membership)
+        pixel_labels = np.full(shape, n_labels, dtype=np.int32)
+        if self.representation == "sparse":
+            pixel_labels.ravel()[self.indices] = self.labels
+        elif self.representation == "bbox":
+            pixel_labels[self.bbox] = self.labels
+        return pixel_labels
+
+    def roi_pixels(self):
+        """
+        Returns numbers of pixels in each ROI.
+        """
+        if self.n_rois == 0:
+            return []
+        return [int(n) for n in self._roi_pixels]
+
+    def coverage(self):
+        """
+        Returns fraction of the frame covered by each ROI.
+        """
+        if self.n_rois == 0:
+            return []
+        return list(self._coverage)
+
+    def counts(self, frame_diff):
+        """
+        Returns (overall, per-ROI) numbers of changed pixels.
+
+        Arguments:
+        frame_diff -- boolean difference frame (any shape, n_pixels elements)
+        """
+        overall = np.count_nonzero(frame_diff)
+        if self.representation == "sparse":
+            np.take(frame_diff.ravel(), self.indices, out=self._gathered)
+            selected = self._gathered
+        elif self.representation == "bbox":
+            selected = frame_diff.reshape(self.shape)[self.bbox]
+        else:
+            return overall, np.zeros(self.n_rois, dtype=np.int64)
+        return overall, self._label_counts(selected).dot(self.membership)
+
+    def block_counts(self, frame_diffs):
+        """
+        Returns (overall, per-ROI) numbers of changed pixels of a block of
+        difference frames, arrays of shape (K,) and (K, n_rois).
+
+        Arguments:
+        frame_diffs -- boolean array of K difference frames, (K, height,
+                       width) or (K, n_pixels)
+        """
+        k = len(frame_diffs)
+        flat = frame_diffs.reshape(k, -1)
+        # count_nonzero along an axis sums, counting frame by frame is
+        # several times faster
+        overall = np.array([np.count_nonzero(f) for f in flat],
+                           dtype=np.int64)
+        if self.representation == "sparse":
+            selected = flat[:, self.indices]
+        elif self.representation == "bbox":
+            selected = frame_diffs.reshape((k,) + self.shape)[
+                (slice(None),) + self.bbox]
+        else:
+            return overall, np.zeros((k, self.n_rois), dtype=np.int64)
+
+        label_counts = np.zeros((k, len(self.membership)), dtype=np.int64)
+        if self._small_labels is None:
+            frame_labels = (np.arange(k).reshape((k,) + (1,)*self.labels.ndim)
+                            * len(self.membership) + self.labels)
+            label_counts = np.bincount(
+                frame_labels[selected], minlength=label_counts.size
+            ).reshape(label_counts.shape)
+        else:
+            work = self._block_work.get(k)
+            if work is None:
+                work = np.empty((k,) + self.labels.shape, dtype=bool)
+                self._block_work = {k: work}
+            for label in self._counted:
+                np.equal(self._small_labels, label, out=self._work)
+                np.logical_and(selected, self._work, out=work)
+                label_counts[:, label] = [np.count_nonzero(w) for w in work]
+        return overall, label_counts.dot(self.membership)
+
+    def _label_counts(self, selected):
+        """
+        Returns numbers of selected pixels with each label, selected being
+        a boolean array of the shape of self.labels.
+        """
+        if self._small_labels is None:
+            return np.bincount(self.labels[selected],
+                               minlength=len(self.membership))
+        label_counts = np.zeros(len(self.membership), dtype=np.int64)
+        for label in self._counted:
+            np.equal(self._small_labels, label, out=self._work)
+            np.logical_and(self._work, selected, out=self._work)
+            label_counts[label] = np.count_nonzero(self._work)
+        return label_counts
+
+    def histograms(self, absdiff, bins=256):
+        """
+        Returns per-ROI histograms of an absolute difference frame (uint8,
+        n_pixels elements) as an (n_rois, bins) array of pixel counts.
+        bins must divide 256, bin i counting values from i*256/bins up to
+        (i+1)*256/bins.
+        """
+        if self.representation == "sparse":
+            values = np.take(absdiff.ravel(), self.indices,
+                             out=self._gathered_values)
+        elif self.representation == "bbox":
+            values = absdiff.reshape(self.shape)[self.bbox]
+        else:
+            return np.zeros((self.n_rois, bins), dtype=np.int64)
+        np.add(self._bin_offsets, values, out=self._bins)
+        label_hists = np.bincount(self._bins.ravel(),
+                                  minlength=256*len(self.membership))
+        if bins != 256:
+            label_hists = label_hists.reshape(-1, bins, 256 // bins).sum(2)
+        return self.membership.T.dot(label_hists.reshape(-1, bins))
+
+    def fractions(self, frame_diff):
+        """
+        Returns list [overall, ROI0, ROI1, ...] of changed pixel fractions,
+        all relative to the full frame size.
+        """
+        overall, rois = self.counts(frame_diff)
+        n = float(frame_diff.size)
+        return [overall / n] + list(rois / n)
@@ -0,0 +1,197 @@
+"""
+Vector geometry of ROIs and its rasterization with NumPy.
+
+An ROI is a list of shapes -- brush strokes and polygons -- in the pixel
+coordinates of the video frame, with y pointing up from the first mask row
+as in the GUI's textures (row i of a mask covers y in [i, i + 1)). Masks
+are rasterized at any resolution by testing pixel centres against the
+shapes, so no OpenGL context is needed.
+"""
+import numpy as np
+
+
+def _pixel_range(low, high, scale, n):
+    """
+    Returns the slice of target pixels (of size scale) whose centres may
+    lie in [low, high], clipped to [0, n).
+    """
+    start = max(0, int(np.floor(low / scale - 0.5)))
+    stop = min(n, int(np.ceil(high / scale - 0.5)) + 1)
+    return slice(start, max(start, stop))
+
+
+def _centres(rows, columns, scale):
+    sx, sy = scale
+    x = (np.arange(columns.start, columns.stop) + 0.5) * sx
+    y = (np.arange(rows.start, rows.stop) + 0.5)[:, None] * sy
+    return x, y
+
+
+def paint_capsule(mask, p0, p1, radius, scale=(1, 1)):
+    """
+    Sets pixels of mask whose centres are within radius of the segment
+    p0-p1 (a disc when p0 equals p1). scale is the size (sx, sy) of a
+    mask pixel in geometry coordinates.
+
+    Returns the (rows, columns) slices of the updated part of mask.
+    """
+    (x0, y0), (x1, y1) = p0, p1
+    rows = _pixel_range(min(y0, y1) - radius, max(y0, y1) + radius,
+                        scale[1], mask.shape[0])
+    columns = _pixel_range(min(x0, x1) - radius, max(x0, x1) + radius,
+                           scale[0], mask.shape[1])
+    if rows.start == rows.stop or columns.start == columns.stop:
+        return rows, columns
+    x, y = _centres(rows, columns, scale)
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx*dx + dy*dy
+    if length2 > 0:
+        t = np.clip(((x - x0)*dx + (y - y0)*dy) / length2, 0, 1)
+        ex, ey = x - x0 - t*dx, y - y0 - t*dy
+    else:
+        ex, ey = x - x0, y - y0
+    mask[rows, columns] |= ex*ex + ey*ey <= radius*radius
+    return rows, columns
+
+
+class Stroke(object):
+    """
+    Brush stroke: the points within width / 2 of a polyline, i.e. a line
+    with round joints and caps (as drawn by the GUI).
+    """
+
+    def __init__(self, points, width):
+        self.points = [tuple(p) for p in points]
+        self.width = float(width)
+
+    def add_point(self, point):
+        self.points.append(tuple(point))
+
+    def paint(self, mask, scale=(1, 1), start=0):
+        """
+        Sets the pixels of the stroke in mask, from point index start on
+        (to paint a stroke while it is drawn). Returns the (rows, columns)
+        slices of the updated part, or None.
+        """
+        radius = self.width / 2
+        points = self.points[max(0, start - 1):]
+        if len(points) == 1:
+            points = points * 2
+        updated = None
+        for p0, p1 in zip(points[:-1], points[1:]):
+            rows, columns = paint_capsule(mask, p0, p1, radius, scale)
+            if updated is None:
+                updated = rows, columns
+            else:
+                updated = (slice(min(rows.start, updated[0].start),
+                                 max(rows.stop, updated[0].stop)),
+                           slice(min(columns.start, updated[1].start),
+                                 max(columns.stop, updated[1].stop)))
+        return updated
+
+    def to_dict(self):
+        return {"type": "stroke", "points": [list(p) for p in self.points],
+                "width": self.width}
+
+
+class Polygon(object):
+    """
+    Polygon filled by the even-odd rule.
+    """
+
+    def __init__(self, vertices):
+        self.vertices = [tuple(v) for v in vertices]
+
+    def paint(self, mask, scale=(1, 1)):
+        """
+        Sets the pixels of the polygon in mask. Returns the (rows,
+        columns) slices of the updated part, or None.
+        """
+        if len(self.vertices) < 3:
+            return None
+        vx, vy = np.array(self.vertices, dtype=np.float64).T
+        rows = _pixel_range(vy.min(), vy.max(), scale[1], mask.shape[0])
+        columns = _pixel_range(vx.min(), vx.max(), scale[0], mask.shape[1])
+        if rows.start == rows.stop or columns.start == columns.stop:
+            return None
+        x, y = _centres(rows, columns, scale)
+        inside = np.zeros((rows.stop - rows.start,
+                           columns.stop - columns.start), dtype=bool)
+        for x0, y0, x1, y1 in zip(vx, vy, np.roll(vx, -1), np.roll(vy, -1)):
+            if y0 == y1:
+                continue
+            # Rows crossing the edge, and whether the crossing is to the
+            # right of the pixel centre
+            crosses = (y0 > y) != (y1 > y)
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= crosses & (x < x_cross)
+        mask[rows, columns] |= inside
+        return rows, columns
+
+    def to_dict(self):
+        return {"type": "polygon",
+                "vertices": [list(v) for v in self.vertices]}
+
+
+SHAPES = {"stroke": lambda d: Stroke(d["points"], d["width"]),
+          "polygon": lambda d: Polygon(d["vertices"])}
+
+
+class ROIGeometry(object):
+    """
+    Shapes of an ROI in the coordinates of a video frame of size (width,
+    height). Shapes are unioned.
+    """
+
+    def __init__(self, size, shapes=None):
+        self.size = tuple(int(s) for s in size)
+        self.shapes = list(shapes or [])
+
+    @property
+    def shape(self):
+        """
+        (height, width) of full resolution masks.
+        """
+        return self.size[1], self.size[0]
+
+    def add(self, shape):
+        self.shapes.append(shape)
+        return shape
+
+    def remove(self, shape):
+        self.shapes.remove(shape)
+
+    def scale(self, shape):
+        """
+        Returns the size (sx, sy) of a pixel of a mask of given (height,
+        width) covering the frame.
+        """
+        return (self.size[0] / float(shape[1]),
+                self.size[1] / float(shape[0]))
+
+    def rasterize(self, shape=None, factor=None):
+        """
+        Returns the boolean mask at (height, width) shape, by default the
+        frame size. With factor, the mask of frames downsampled by factor
+        (see resample.downsampled_shape) is returned: every mask pixel
+        covers factor x factor frame pixels.
+        """
+        if factor is not None:
+            shape = self.shape[0] // factor, self.shape[1] // factor
+            scale = (factor, factor)
+        else:
+            shape = self.shape if shape is None else tuple(shape)
+            scale = self.scale(shape)
+        mask = np.zeros(shape, dtype=bool)
+        for s in self.shapes:
+            s.paint(mask, scale)
+        return mask
+
+    def to_dict(self):
+        return {"size": list(self.size),
+                "shapes": [s.to_dict() for s in self.shapes]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["size"],
+                   [SHAPES[d["type"]](d) for d in data["shapes"]])
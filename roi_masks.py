@@ -0,0 +1,65 @@
+import numpy as np
+
+from resample import resize_mask
+
+
+class PackedMask(object):
+    """
+    Boolean ROI mask stored bit-packed (one bit per pixel, see
+    numpy.packbits), an eighth of the size of a boolean array.
+
+    Masks at other resolutions (e.g. of the widget showing the video) are
+    sampled with resized and kept, so each is computed once.
+    """
+
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+        self._resized = {}
+
+    @classmethod
+    def pack(cls, mask):
+        """
+        Returns the PackedMask of a boolean (height, width) array.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        return cls(np.packbits(mask.ravel()), mask.shape)
+
+    def unpack(self):
+        """
+        Returns the mask as a boolean array.
+        """
+        size = self.shape[0]*self.shape[1]
+        return np.unpackbits(self.bits, count=size).view(bool).reshape(
+            self.shape)
+
+    def resized(self, shape):
+        """
+        Returns the PackedMask sampled at another (height, width), see
+        resample.resize_mask.
+        """
+        shape = tuple(int(s) for s in shape)
+        if shape == self.shape:
+            return self
+        if shape not in self._resized:
+            self._resized[shape] = PackedMask.pack(
+                resize_mask(self.unpack(), shape))
+        return self._resized[shape]
+
+
+def pack_mask(mask):
+    """
+    Returns the packed bits of a boolean mask or PackedMask.
+    """
+    if isinstance(mask, PackedMask):
+        return mask.bits
+    return np.packbits(np.asarray(mask, dtype=bool).ravel())
+
+
+def unpack_mask(mask):
+    """
+    Returns a boolean array of a boolean mask or PackedMask.
+    """
+    if isinstance(mask, PackedMask):
+        return mask.unpack()
+    return np.asarray(mask, dtype=bool)
@@ -0,0 +1,264 @@
+import math
+import time
+
+from frame_source import COUNTERS
+
+# Stages of an analysis timed by PipelineStats
+STAGES = ("decode", "diff", "aggregate", "callback", "output")
+# Default seconds between calls of the stats callback
+DEFAULT_STATS_INTERVAL = 1.0
+# Default seconds between progress records
+DEFAULT_PROGRESS_INTERVAL = 1.0
+# Seconds over which ProgressMeter averages rates
+DEFAULT_PROGRESS_SMOOTHING = 10.0
+
+
+class PipelineStats(object):
+    """
+    Timing counters of an analysis (see calculate_frame_diffs_wcall).
+
+    Cumulative seconds are kept per stage:
+    decode -- waiting for the next frame of the frame source
+    diff -- differencing frames (DiffKernel or the compiled kernel, which
+            also aggregates)
+    aggregate -- ROI counts
+    callback -- the progress callback
+    output -- writing rows, and recording differences and per-ROI
+              histograms
+
+    Counters of frame sources (see frame_source.COUNTERS) are summed, and
+    the number of frames waiting in the source's queue is sampled whenever
+    a frame is taken. When callback is given, it is called with the stats
+    at most every interval seconds while frames are read.
+
+    Stats are only collected when a PipelineStats is passed, otherwise the
+    pipeline does not look at the clock.
+    """
+
+    def __init__(self, callback=None, interval=DEFAULT_STATS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.times = dict.fromkeys(STAGES, 0.0)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.rows = 0
+        self.frames = 0
+        self.queue_depth_total = 0
+        self.queue_depth_max = 0
+        self.started = time.perf_counter()
+        self._last_report = self.started
+        self._source = None
+
+    def add(self, stage, start):
+        """
+        Adds the time since start (a time.perf_counter() value) to stage.
+        Returns the current time, the start of a following stage.
+        """
+        now = time.perf_counter()
+        self.times[stage] += now - start
+        return now
+
+    def read(self, source, frames):
+        """
+        Yields the items of frames, an iterator over source, timing the wait
+        for each of them as decode.
+        """
+        self._source = source
+        frames = iter(frames)
+        while True:
+            start = time.perf_counter()
+            item = next(frames, None)
+            now = self.add("decode", start)
+            if item is None:
+                return
+            depth = source.queue_depth()
+            self.frames += 1
+            self.queue_depth_total += depth
+            self.queue_depth_max = max(self.queue_depth_max, depth)
+            if (self.callback is not None
+                    and now - self._last_report >= self.interval):
+                self._last_report = now
+                self.callback(self)
+            yield item
+
+    def finish(self, source):
+        """
+        Adds the counters of a source which is no longer read.
+        """
+        for k in COUNTERS:
+            self.counters[k] += source.counters[k]
+        if self._source is source:
+            self._source = None
+
+    def merge(self, summary):
+        """
+        Adds a summary of other stats, e.g. of a chunk worker process.
+        """
+        for stage in STAGES:
+            self.times[stage] += summary["stages"][stage]
+        for k in COUNTERS:
+            self.counters[k] += summary[k]
+        self.rows += summary["rows"]
+        self.frames += summary["frames"]
+        self.queue_depth_total += summary["queue_depth_total"]
+        self.queue_depth_max = max(self.queue_depth_max,
+                                   summary["queue_depth_max"])
+        if self.callback is not None:
+            self.callback(self)
+
+    def summary(self):
+        """
+        Returns the stats as a JSON serializable dict; source counters
+        include the source being read.
+        """
+        counters = dict(self.counters)
+        if self._source is not None:
+            for k in COUNTERS:
+                counters[k] += self._source.counters[k]
+        summary = {"elapsed": time.perf_counter() - self.started,
+                   "stages": dict(self.times),
+                   "rows": self.rows,
+                   "frames": self.frames,
+                   "queue_depth_total": self.queue_depth_total,
+                   "queue_depth_mean": (self.queue_depth_total
+                                        / float(max(1, self.frames))),
+                   "queue_depth_max": self.queue_depth_max}
+        summary.update(counters)
+        return summary
+
+
+class ProgressMeter(object):
+    """
+    Progress of an analysis (see calculate_frame_diffs_wcall) reported as
+    records to callback, at most every interval seconds and once at the
+    end. A record is a JSON serializable dict:
+
+    frames -- frame differences computed so far
+    fps -- frames per second since the previous record
+    fps_smoothed -- fps averaged over about smoothing seconds
+    realtime -- seconds of selected video analysed per second (smoothed)
+    eta -- estimated seconds until the end, or None
+    range -- index of the current cut range
+    time -- timestamp of the last frame, in seconds
+    progress -- fraction of the selected video analysed
+    elapsed -- seconds since the analysis started
+
+    Between records, update only counts frames and reads the clock, so
+    short intervals are cheap.
+    """
+
+    def __init__(self, callback, interval=DEFAULT_PROGRESS_INTERVAL,
+                 smoothing=DEFAULT_PROGRESS_SMOOTHING):
+        self.callback = callback
+        self.interval = interval
+        self.smoothing = smoothing
+        self.frames = 0
+        self.range = 0
+        self.time = 0.0
+        self.done = None
+        self.spans = []
+        self.total = 0.0
+        self.fps_smoothed = None
+        self.realtime = None
+        self.started = time.perf_counter()
+        self._last = None
+        self._cut_ranges = ([0, 1], [True])
+
+    def select(self, cut_ranges):
+        """
+        Sets the cut ranges (see calculate_frame_diffs_wcall) of which the
+        selected ones are analysed.
+        """
+        self._cut_ranges = cut_ranges
+
+    def start(self, duration):
+        """
+        Starts measuring an analysis of a video of duration seconds.
+        """
+        cutpoints, selected = self._cut_ranges
+        self.spans = [(a*duration, b*duration) for a, b, s
+                      in zip(cutpoints[:-1], cutpoints[1:], selected) if s]
+        self.total = self.selected_time(0, duration)
+
+    def selected_time(self, start, stop):
+        """
+        Returns seconds of selected ranges between start and stop.
+        """
+        return sum(max(0, min(b, stop) - max(a, start))
+                   for a, b in self.spans)
+
+    def update(self, crange, t, frames=1, done=None):
+        """
+        Counts frames analysed up to timestamp t in range crange. done is
+        the analysed time of selected ranges when it does not follow from t
+        (chunks analysed in parallel).
+        """
+        now = time.perf_counter()
+        if self._last is None:
+            # Rates are measured from the first frame, so that resumed
+            # analyses do not count the resumed part
+            self._last = (now, self.frames, self._done(t, done))
+        self.frames += frames
+        self.range = crange
+        self.time = t
+        self.done = done
+        if now - self._last[0] >= self.interval:
+            self.report(now)
+
+    def _done(self, t, done):
+        return self.selected_time(0, t) if done is None else done
+
+    def report(self, now=None):
+        """
+        Passes a record of the current progress to the callback.
+        """
+        if now is None:
+            now = time.perf_counter()
+        done = self._done(self.time, self.done)
+        if self._last is None:
+            self._last = (now, self.frames, done)
+        last, last_frames, last_done = self._last
+        dt = now - last
+        fps = (self.frames - last_frames) / dt if dt > 0 else None
+        realtime = (done - last_done) / dt if dt > 0 else None
+        if fps is not None:
+            if self.fps_smoothed is None:
+                self.fps_smoothed, self.realtime = fps, realtime
+            else:
+                # Exponential moving average in time
+                weight = 1 - math.exp(-dt / self.smoothing)
+                self.fps_smoothed += weight * (fps - self.fps_smoothed)
+                self.realtime += weight * (realtime - self.realtime)
+        eta = None
+        if self.realtime:
+            eta = max(0.0, self.total - done) / self.realtime
+        self._last = (now, self.frames, done)
+        self.callback({"frames": self.frames,
+                       "fps": fps,
+                       "fps_smoothed": self.fps_smoothed,
+                       "realtime": self.realtime,
+                       "eta": eta,
+                       "range": self.range,
+                       "time": self.time,
+                       "progress": (min(1.0, done / self.total)
+                                    if self.total else 0.0),
+                       "elapsed": now - self.started})
+
+    def finish(self):
+        """
+        Reports the final progress.
+        """
+        self.done = self.total
+        self.report()
+
+
+def format_progress(record):
+    """
+    Returns a one-line text of a progress record (see ProgressMeter).
+    """
+    text = "{0:.1%}, {1} frames".format(record["progress"], record["frames"])
+    if record["fps_smoothed"] is not None:
+        text += ", {0:.1f} frames/s, {1:.2f}x realtime".format(
+            record["fps_smoothed"], record["realtime"])
+    if record["eta"] is not None:
+        text += ", {0:.0f} s left".format(record["eta"])
+    return text + ", range {0}".format(record["range"])
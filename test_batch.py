@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+
+import batch
+from roi_config import save_config
+
+
+def test_output_paths_keep_directories_of_colliding_names(tmp_path):
+    videos = [str(tmp_path / name) for name in
+              ("a/cam.avi", "b/cam.avi", "b/cam.mp4", "solo.avi")]
+    outputs = batch.output_paths(videos, "out", ".csv")
+    assert outputs == [os.path.join("out", "a", "cam.csv"),
+                       os.path.join("out", "b", "cam.avi.csv"),
+                       os.path.join("out", "b", "cam.mp4.csv"),
+                       os.path.join("out", "solo.csv")]
+
+
+def test_output_paths_of_unique_names(tmp_path):
+    videos = [str(tmp_path / "a" / "one.avi"), str(tmp_path / "two.avi")]
+    assert batch.output_paths(videos, "out", ".npz") == [
+        os.path.join("out", "one.npz"), os.path.join("out", "two.npz")]
+
+
+def test_failed_video_leaves_no_result_files(tmp_path, monkeypatch):
+    config_file = str(tmp_path / "config.npz")
+    save_config(config_file, [np.ones((4, 4), dtype=bool)], ([0, 1], [True]))
+    output_file = str(tmp_path / "video.csv")
+
+    def fail(video_file, masks, cut_ranges, output, histogram_output,
+             **kwargs):
+        for filename in (output, output + ".json", histogram_output):
+            open(filename, "w").close()
+        raise RuntimeError("decoder failed")
+
+    monkeypatch.setattr(batch, "calculate_frame_diffs_wcall", fail)
+    row = batch.process_video("video.avi", config_file, output_file,
+                              histogram_bins=32)
+    assert row["Status"] == "failed"
+    assert os.listdir(str(tmp_path)) == ["config.npz"]
+
+
+def test_run_batch_with_colliding_names(tmp_path, video_file, masks):
+    videos = []
+    for directory in ("a", "b"):
+        os.makedirs(str(tmp_path / directory))
+        videos.append(str(tmp_path / directory / "video.avi"))
+        with open(video_file, "rb") as src, open(videos[-1], "wb") as dst:
+            dst.write(src.read())
+    config_file = str(tmp_path / "config.npz")
+    save_config(config_file, masks, ([0, 1], [True]))
+    output_dir = str(tmp_path / "out")
+    summary = batch.run_batch(videos, config_file, output_dir, workers=1)
+    assert [row["Status"] for row in summary] == ["ok", "ok"]
+    assert summary[0]["Output"] != summary[1]["Output"]
+    for row in summary:
+        assert os.path.isfile(row["Output"])
+        assert not os.path.exists(batch.partial_path(row["Output"]))
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from kernels import SingleThreshold
+from roi_engine import ROIEngine
+
+pytest.importorskip("numba")
+from compiled_kernels import CompiledSingleThreshold  # noqa: E402
+
+SHAPE = (48, 64)
+
+
+def random_masks(n_rois, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.rand(*SHAPE) < 0.3 for _ in range(n_rois)]
+
+
+def rectangle_masks(n_rois, seed=0):
+    # Rows of few label runs are counted by runs, see diff_counts
+    rng = np.random.RandomState(seed)
+    masks = []
+    for _ in range(n_rois):
+        top, left = rng.randint(0, 24, size=2)
+        mask = np.zeros(SHAPE, dtype=bool)
+        mask[top:top + 20, left:left + 40] = True
+        masks.append(mask)
+    return masks
+
+
+@pytest.mark.parametrize("threshold", [-3, 0, 7.5, 10, 127, 128, 255])
+@pytest.mark.parametrize("n_rois", [0, 1, 4, 12])
+@pytest.mark.parametrize("make_masks", [random_masks, rectangle_masks])
+def test_compiled_kernel_matches_numpy(threshold, n_rois, make_masks):
+    rng = np.random.RandomState(n_rois)
+    frames = [rng.randint(0, 256, size=SHAPE).astype(np.uint8)
+              for _ in range(4)]
+    # Extreme values exercise differences of 0 and 255
+    frames[1][:4] = 0
+    frames[2][:4] = 255
+    engine = ROIEngine(make_masks(n_rois))
+    reference = SingleThreshold(SHAPE, threshold, engine)
+    compiled = CompiledSingleThreshold(SHAPE, threshold, engine)
+    for oframe, cframe in zip(frames, frames[1:]):
+        assert compiled(cframe, oframe) == reference(cframe, oframe)
+        assert np.array_equal(compiled.frame_diff(), reference.frame_diff())
+        assert np.array_equal(compiled.kernel.absdiff,
+                              reference.kernel.absdiff)
@@ -0,0 +1,133 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from frame_cache import DiffCache, DiffRecorder
+from frame_differences import AnalysisCancelled, calculate_frame_diffs_wcall
+from frame_source import FrameSource
+from results import load_results
+
+# One range covering the whole video, and four ranges of which the second
+# is skipped (so that analysis seeks over it)
+FULL_RANGE = ([0, 1], [True])
+CUT_RANGES = ([0, 0.3, 0.5, 0.7, 1], [True, False, True, True])
+
+
+def reference_fractions(video_file, masks, th):
+    """
+    Rows [Range, Time, Overall, ROI0, ...] of FULL_RANGE computed directly
+    from consecutive frames with the rule th < |d| < 256 - th.
+    """
+    with FrameSource(video_file) as source:
+        frames = [(frame.astype(np.int16), t) for frame, t in source]
+    rows = []
+    for (oframe, _), (cframe, t) in zip(frames, frames[1:]):
+        d = np.abs(cframe - oframe)
+        changed = (d > th) & (d < 256 - th)
+        rows.append([1, t, changed.mean()]
+                    + [(changed & m).sum() / float(changed.size)
+                       for m in masks])
+    return np.array(rows)
+
+
+def analyse(video_file, masks, cut_ranges=CUT_RANGES, th=10, **kwargs):
+    # Results without the ROI coverage row
+    return calculate_frame_diffs_wcall(video_file, masks, cut_ranges, th,
+                                       **kwargs).iloc[1:].reset_index(
+                                           drop=True)
+
+
+@pytest.mark.parametrize("th", [0, 10, 127])
+def test_results_match_reference(video_file, masks, th):
+    results = analyse(video_file, masks, FULL_RANGE, th)
+    expected = reference_fractions(video_file, masks, th)
+    assert results.shape == expected.shape
+    assert np.array_equal(results.values, expected)
+
+
+@pytest.mark.parametrize("block_frames", [1, 7, None])
+def test_block_frames_do_not_change_results(video_file, masks,
+                                            block_frames):
+    # Blocks are only used by the NumPy kernels
+    assert analyse(video_file, masks, block_frames=block_frames,
+                   backend="numpy").equals(analyse(video_file, masks))
+
+
+def test_parallel_chunks_match_sequential(video_file, masks):
+    assert analyse(video_file, masks, workers=2, chunk_duration=0.5).equals(
+        analyse(video_file, masks))
+
+
+@pytest.mark.parametrize("block_frames", [1, 8])
+def test_resume_from_checkpoint(tmp_path, video_file, masks, block_frames):
+    output = str(tmp_path / "results.npz")
+    cancel = threading.Event()
+
+    def callback(progress, frame_diff):
+        if progress > 0.6:
+            cancel.set()
+
+    with pytest.raises(AnalysisCancelled):
+        calculate_frame_diffs_wcall(video_file, masks, CUT_RANGES, 10,
+                                    callback=callback, sec_callback=0.2,
+                                    output=output, checkpoint_interval=1000,
+                                    cancel=cancel, block_frames=block_frames)
+    calculate_frame_diffs_wcall(video_file, masks, CUT_RANGES, 10,
+                                output=output, checkpoint_interval=1000,
+                                resume=True, block_frames=block_frames)
+    results, _ = load_results(output)
+    assert results.equals(analyse(video_file, masks))
+
+
+def test_sweep_matches_separate_runs(video_file, masks):
+    thresholds = [0, 10, 25.5, 127]
+    sweep = analyse(video_file, masks, th=thresholds)
+    for th in thresholds:
+        single = analyse(video_file, masks, th=th)
+        assert np.array_equal(sweep.Time, single.Time)
+        for column in ("Overall", "ROI0", "ROI1"):
+            assert np.array_equal(sweep["{0}_{1}".format(column, th)],
+                                  single[column])
+
+
+def test_frame_cache_matches_decoding(tmp_path, video_file, masks):
+    expected = analyse(video_file, masks)
+    cache_dir = str(tmp_path / "frames")
+    # The first run fills the cache, the second reads frames from it
+    for _ in range(2):
+        assert analyse(video_file, masks, cache_dir=cache_dir).equals(
+            expected)
+
+
+def test_diff_cache_matches_decoding(tmp_path, video_file, masks):
+    cache_dir = str(tmp_path / "diffs")
+    assert analyse(video_file, masks, diff_cache_dir=cache_dir).equals(
+        analyse(video_file, masks))
+    # Other ROIs are computed from the cached differences
+    other = [~m for m in masks]
+    assert analyse(video_file, other, diff_cache_dir=cache_dir).equals(
+        analyse(video_file, other))
+
+
+@pytest.mark.parametrize("cache_size", [100, 2000, 10**9])
+def test_diff_cache_size_limit(tmp_path, video_file, masks, cache_size):
+    # 160 x 120 differences take 2400 bytes per frame
+    cache = DiffCache(str(tmp_path), cache_size)
+    expected = analyse(video_file, masks)
+    assert analyse(video_file, masks, diff_cache_dir=str(tmp_path),
+                   cache_size=cache_size).equals(expected)
+    entries = cache.entries()
+    assert sum(size for _, size, _ in entries) <= cache_size
+    assert len(entries) == (cache_size == 10**9)
+
+
+def test_diff_recorder_discards_recording_over_size_limit(tmp_path):
+    cache = DiffCache(str(tmp_path), 5000)
+    recorder = DiffRecorder(cache, str(tmp_path / "entry"), {})
+    frame_diff = np.ones((120, 160), dtype=bool)
+    for i in range(3):
+        recorder.append(1, i / 25.0, frame_diff)
+    assert recorder.discarded and not recorder.rows
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,52 @@
+import numpy as np
+
+from frame_differences import calculate_frame_diffs_wcall
+from frame_source import FrameSource
+
+CUT_RANGES = ([0, 1], [True])
+
+
+def test_decoder_downsampling_delivers_scaled_frames_only(video_file):
+    with FrameSource(video_file, downsample=2,
+                     downsample_mode="decoder") as source:
+        frames = list(source)
+    assert frames
+    assert all(frame.shape == source.frame_shape for frame, _ in frames)
+    times = [t for _, t in frames]
+    assert times == sorted(times)
+
+
+def test_decoder_downsampling_is_deterministic(video_file, masks):
+    runs = [calculate_frame_diffs_wcall(video_file, masks, CUT_RANGES, 10,
+                                        downsample=2,
+                                        downsample_mode="decoder")
+            for _ in range(3)]
+    for run in runs[1:]:
+        assert run.equals(runs[0])
+
+
+def test_decoder_downsampling_is_close_to_block_mode(video_file, masks):
+    decoder = calculate_frame_diffs_wcall(video_file, masks, CUT_RANGES, 10,
+                                          downsample=2,
+                                          downsample_mode="decoder")
+    block = calculate_frame_diffs_wcall(video_file, masks, CUT_RANGES, 10,
+                                        downsample=2)
+    both = decoder.merge(block, on=["Range", "Time"])
+    assert len(both) >= len(block) - 2
+    for column in ("Overall", "ROI0", "ROI1"):
+        difference = np.abs(both[column + "_x"] - both[column + "_y"])
+        assert difference.max() < 0.02
+
+
+def test_decoder_downsampling_to_odd_size(video_file, masks):
+    # 120 / 8 = 15 rows, which the scaler rounds to an even height
+    with FrameSource(video_file, downsample=8,
+                     downsample_mode="decoder") as source:
+        frames = list(source)
+    assert frames
+    assert all(frame.shape == source.frame_shape for frame, _ in frames)
+    results = calculate_frame_diffs_wcall(video_file, masks, CUT_RANGES, 10,
+                                          downsample=8,
+                                          downsample_mode="decoder")
+    assert len(results) == len(frames)
+    assert results.Overall.iloc[1:].max() > 0
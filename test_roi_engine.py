@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import roi_engine
+from roi_engine import ROIEngine, membership_labels
+
+
+def unique_rows(masks):
+    stacked = np.stack([m.ravel() for m in masks], axis=1)
+    membership, labels = np.unique(stacked, axis=0, return_inverse=True)
+    return membership, labels.ravel()
+
+
+@pytest.mark.parametrize("n_rois", [1, 2, 3, 6, 9])
+def test_membership_labels_match_unique_rows(n_rois):
+    rng = np.random.RandomState(n_rois)
+    masks = [rng.rand(40, 60) < 0.4 for _ in range(n_rois)]
+    membership, labels = membership_labels(masks)
+    expected_membership, expected_labels = unique_rows(masks)
+    assert np.array_equal(membership, expected_membership)
+    assert np.array_equal(labels, expected_labels)
+
+
+def test_many_rois_fall_back_to_unique_rows(monkeypatch):
+    monkeypatch.setattr(roi_engine, "MAX_BIT_CODED_ROIS", 2)
+    rng = np.random.RandomState(0)
+    masks = [rng.rand(40, 60) < 0.4 for _ in range(4)]
+    membership, labels = membership_labels(masks)
+    expected_membership, expected_labels = unique_rows(masks)
+    assert np.array_equal(membership, expected_membership)
+    assert np.array_equal(labels, expected_labels)
+
+
+def test_fractions_count_changed_pixels_per_roi():
+    rng = np.random.RandomState(1)
+    masks = [rng.rand(40, 60) < 0.3 for _ in range(3)]
+    frame_diff = rng.rand(40, 60) < 0.5
+    engine = ROIEngine(masks)
+    expected = [frame_diff.mean()] + [(frame_diff & m).sum() / m.size
+                                      for m in masks]
+    assert np.allclose(engine.fractions(frame_diff), expected)
@@ -0,0 +1,17 @@
+import numpy as np
+
+from roi_geometry import ROIGeometry, Stroke
+
+
+def test_remove_keeps_other_shapes():
+    geometry = ROIGeometry((40, 30))
+    first = geometry.add(Stroke([(5, 5), (20, 5)], 4))
+    second = geometry.add(Stroke([(10, 20)], 6))
+    # An equal stroke drawn again is a separate shape
+    again = geometry.add(Stroke([(5, 5), (20, 5)], 4))
+    geometry.remove(first)
+    assert geometry.shapes == [second, again]
+    geometry.remove(again)
+    expected = np.zeros((30, 40), dtype=bool)
+    second.paint(expected)
+    assert np.array_equal(geometry.rasterize(), expected)
@@ -0,0 +1,17 @@
+import numpy as np
+
+from roi_masks import PackedMask
+
+
+def test_resized_samples_mask_once_per_shape():
+    mask = np.zeros((120, 160), dtype=bool)
+    mask[30:90, 40:80] = True
+    packed = PackedMask.pack(mask)
+    display = packed.resized((60, 80))
+    expected = np.zeros((60, 80), dtype=bool)
+    expected[15:45, 20:40] = True
+    assert np.array_equal(display.unpack(), expected)
+    assert packed.resized((60, 80)) is display
+    assert packed.resized((120, 160)) is packed
+    assert np.array_equal(packed.resized((240, 320)).unpack(),
+                          mask.repeat(2, axis=0).repeat(2, axis=1))